@@ -0,0 +1,74 @@
+"""对比文件接收循环：recv(8192) 每块分配新对象 与 recv_into 复用缓冲区
+
+用法: python benchmarks/recv_loop.py [总大小MB] [缓冲区KB]
+"""
+import hashlib
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+BLOCK = os.urandom(1024 * 1024)
+
+def serve(server, size):
+    conn, _ = server.accept()
+    with conn:
+        sent = 0
+        while sent < size:
+            n = min(len(BLOCK), size - sent)
+            conn.sendall(BLOCK[:n])
+            sent += n
+
+def receive_recv(sock, f, size, buffer_size):
+    hash_md5 = hashlib.md5()
+    received = 0
+    while received < size:
+        chunk = sock.recv(min(8192, size - received))
+        if not chunk:
+            break
+        f.write(chunk)
+        hash_md5.update(chunk)
+        received += len(chunk)
+    return received
+
+def receive_recv_into(sock, f, size, buffer_size):
+    hash_md5 = hashlib.md5()
+    buffer = memoryview(bytearray(buffer_size))
+    received = 0
+    while received < size:
+        n = sock.recv_into(buffer, min(buffer_size, size - received))
+        if not n:
+            break
+        chunk = buffer[:n]
+        f.write(chunk)
+        hash_md5.update(chunk)
+        received += n
+    return received
+
+def run(receive, size, buffer_size):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    thread = threading.Thread(target=serve, args=(server, size))
+    thread.start()
+    with socket.create_connection(server.getsockname()) as sock, tempfile.TemporaryFile() as f:
+        start = time.perf_counter()
+        received = receive(sock, f, size, buffer_size)
+        elapsed = time.perf_counter() - start
+    thread.join()
+    server.close()
+    assert received == size
+    return size / elapsed / (1024 * 1024)
+
+def main():
+    size = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 1024 * 1024 * 1024
+    buffer_size = int(sys.argv[2]) * 1024 if len(sys.argv) > 2 else 1024 * 1024
+    for name, receive in (('recv(8192)', receive_recv),
+                          (f'recv_into({buffer_size // 1024} KB)', receive_recv_into)):
+        rates = [run(receive, size, buffer_size) for _ in range(3)]
+        print(f"{name:>22}: {max(rates):8.1f} MB/s (best of 3)")
+
+if __name__ == '__main__':
+    main()
@@ -14,15 +14,21 @@ def main():
     
     # 连接信号和槽
     window.send_message_signal.connect(udp_client.send_message)
+    window.send_group_signal.connect(udp_client.send_group_message)
     window.send_file_signal.connect(udp_client.send_file_request)
     
     udp_client.message_received.connect(window.receive_message)
+    udp_client.message_status.connect(window.update_delivery_status)
+    udp_client.group_message_received.connect(window.receive_group_message)
     udp_client.user_online.connect(window.add_user)
     udp_client.user_offline.connect(window.remove_user)
+    udp_client.user_restored.connect(window.add_stale_user)
     udp_client.file_request.connect(window.handle_file_request)
+    udp_client.batch_request.connect(window.handle_batch_request)
     
     # 连接文件传输信号
     udp_client.file_transfer_request.connect(file_server.send_file)
+    udp_client.batch_manifest.connect(file_server.set_batch_manifest)
     file_server.transfer_progress.connect(window.update_transfer_progress)
     file_server.transfer_complete.connect(window.transfer_complete)
     file_server.transfer_status.connect(window.update_transfer_status)
@@ -34,8 +40,8 @@ def main():
     # 连接设置相关信号
     window.settings_changed_signal.connect(udp_client.set_username)
     
-    # 连接刷新信号
-    window.refresh_signal.connect(udp_client.broadcast_presence)
+    # 连接刷新信号：查询谁在线
+    window.refresh_signal.connect(udp_client.query_roster)
     
     # 连接文件传输相关信号
     window.file_response_signal.connect(udp_client.send_file_response)
@@ -45,11 +51,17 @@ def main():
     # 连接文件保存路径信号
     window.set_save_path_signal.connect(file_server.set_save_path)
     
+    # 同步对方支持的传输扩展
+    udp_client.peer_features.connect(file_server.set_peer_features)
+    
     # 连接文件拒绝信号
     udp_client.file_rejected.connect(window.handle_file_rejected)
     
-    # 广播在线状态
-    udp_client.broadcast_presence()
+    # 先显示上次的在线列表再查询谁在线，退出时通知其他用户
+    udp_client.restore_roster()
+    app.aboutToQuit.connect(udp_client.announce_offline)
+    app.aboutToQuit.connect(window.history.close)
+    app.aboutToQuit.connect(file_server.hash_cache.close)  # 写入尚未保存的文件摘要
     
     # 启动文件接收服务器
     file_server.start_receiving()
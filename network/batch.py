@@ -0,0 +1,44 @@
+import os
+import stat
+import struct
+
+FILE_HEADER = struct.Struct('!IQ')  # index, size
+END_OF_BATCH = 0xFFFFFFFF  # 所有文件发送完毕
+SMALL_FILE_SIZE = 256 * 1024  # 小文件整个读入后写入带缓冲的连接，多个文件合并成一次发送
+
+def build_manifest(root):
+    """遍历目录，返回 (dirs, files)
+
+    路径相对于 root，统一用 / 分隔；files 中每项为 {'path': ..., 'size': ...}，
+    只包含普通文件，目录中的空目录也会记录以便接收方重建。
+    """
+    dirs, files = [], []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        rel_dir = os.path.relpath(dirpath, root)
+        if rel_dir != '.':
+            dirs.append(rel_dir.replace(os.sep, '/'))
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            files.append({
+                'path': os.path.relpath(path, root).replace(os.sep, '/'),
+                'size': st.st_size
+            })
+    return dirs, files
+
+def local_path(root, rel_path):
+    """把清单中的相对路径映射到 root 下，拒绝绝对路径、.. 等会越出 root 的路径"""
+    parts = rel_path.split('/')
+    if any(part in ('', '.', '..') or '\\' in part or ':' in part for part in parts):
+        raise Exception(f"非法的文件路径: {rel_path}")
+    root = os.path.abspath(root)
+    path = os.path.abspath(os.path.join(root, *parts))
+    if os.path.commonpath([root, path]) != root:
+        raise Exception(f"非法的文件路径: {rel_path}")
+    return path
@@ -0,0 +1,92 @@
+import struct
+import time
+
+try:
+    import zstandard
+except ImportError:  # zstd 为可选依赖，缺失时不协商压缩
+    zstandard = None
+
+BLOCK_SIZE = 1024 * 1024  # 每个压缩块对应的原始数据大小
+BLOCK_HEADER = struct.Struct('!BI')  # kind, length
+RAW, ZSTD = 0, 1
+SAMPLE_SIZE = 256 * 1024
+SAMPLE_BLOCKS = 4  # 前几个块的压缩率不理想则之后直接发送原始数据
+MIN_RATIO = 0.9  # 压缩后至少要小 10% 才值得
+MIN_LEVEL = 1
+MAX_LEVEL = 9
+DEFAULT_LEVEL = 3
+
+def available():
+    return zstandard is not None
+
+def worth_compressing(sample):
+    """用文件开头的样本判断是否值得压缩，已压缩过的数据（图片、压缩包等）直接走原始模式"""
+    if not available() or not sample:
+        return False
+    packed = zstandard.ZstdCompressor(level=MIN_LEVEL).compress(sample)
+    return len(packed) < len(sample) * MIN_RATIO
+
+class BlockCompressor:
+    """把数据按块独立压缩后发送，每块带有类型和长度头
+
+    根据压缩耗时与发送耗时调整压缩级别：发送阻塞更久说明网络是瓶颈，提高级别换取更小的数据；
+    压缩更慢说明 CPU 是瓶颈，降低级别。
+    """
+
+    def __init__(self, level=DEFAULT_LEVEL):
+        self.level = level
+        self.compressors = {}  # {level: ZstdCompressor}
+        self.enabled = True
+        self.blocks = 0
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+
+    def send_block(self, sock, data):
+        start = time.monotonic()
+        kind, payload = RAW, data
+        if self.enabled:
+            compressor = self.compressors.get(self.level)
+            if compressor is None:
+                compressor = zstandard.ZstdCompressor(level=self.level)
+                self.compressors[self.level] = compressor
+            packed = compressor.compress(data)
+            if len(packed) < len(data):
+                kind, payload = ZSTD, packed
+        compressed = time.monotonic()
+        sock.sendall(BLOCK_HEADER.pack(kind, len(payload)))
+        sock.sendall(payload)
+        sent = time.monotonic()
+
+        self.blocks += 1
+        self.raw_bytes += len(data)
+        self.wire_bytes += len(payload)
+        if self.enabled:
+            self.adjust(compressed - start, sent - compressed)
+        return BLOCK_HEADER.size + len(payload)
+
+    def adjust(self, compress_time, send_time):
+        if self.blocks == SAMPLE_BLOCKS and self.wire_bytes > self.raw_bytes * MIN_RATIO:
+            self.enabled = False
+        elif send_time > compress_time * 2 and self.level < MAX_LEVEL:
+            self.level += 1
+        elif compress_time > send_time * 2 and self.level > MIN_LEVEL:
+            self.level -= 1
+
+    def ratio(self):
+        return self.wire_bytes / self.raw_bytes if self.raw_bytes else 1.0
+
+class BlockDecompressor:
+    """读取 BlockCompressor 发出的数据块；read(n) 必须恰好返回 n 字节"""
+
+    def __init__(self, read):
+        self.read = read
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def read_block(self):
+        kind, length = BLOCK_HEADER.unpack(self.read(BLOCK_HEADER.size))
+        payload = self.read(length)
+        if kind == RAW:
+            return payload
+        if kind == ZSTD:
+            return self.decompressor.decompress(payload, max_output_size=BLOCK_SIZE)
+        raise Exception(f"未知的数据块类型: {kind}")
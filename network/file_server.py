@@ -1,10 +1,49 @@
-from PySide6.QtCore import QObject, Signal, QThread
+from PySide6.QtCore import QObject, Signal
+import asyncio
 import socket
 import json
 import os
 import hashlib
-from dataclasses import dataclass
+import io
+import select
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from enum import Enum
+from network.hash_cache import HashCache
+from network.range_transfer import (RangeReceiveSession, RangeSender, MAX_STREAMS,
+                                    PARALLEL_MIN_SIZE, SEGMENT_HEADER)
+from network.resume import ChunkManifest
+from network import compression
+from network import merkle
+from network import batch
+from network import mux
+from network import pipeline
+from network.transfer_engine import TransferEngine
+from network.scheduler import TransferScheduler
+
+SENDFILE_WINDOW = 4 * 1024 * 1024  # 每次交给内核 sendfile 的字节数
+BUFFER_SIZE = 256 * 1024  # 无法零拷贝或需要边发边算摘要时的缓冲块大小
+RECV_BUFFER_SIZE = 1024 * 1024  # 单连接接收时复用的缓冲区大小，可在设置中调整
+SOCKET_BUFFER_SIZE = 0  # 接收套接字的 SO_RCVBUF，0 表示由系统自动调整
+TELEMETRY_INTERVAL = 0.1  # 每个传输的进度统计最多 10 次/秒
+RATE_SMOOTHING = 0.3  # 速率指数平滑系数
+
+# 本端支持的传输扩展，接受文件时随 file_response 告知发送方
+#   trailer: 发送方边发送边计算 MD5，摘要作为尾部跟在文件内容之后
+#   ranges: 大文件拆成数据段经多条连接并行传输，接收方按偏移写入
+#   zstd: 单连接传输时按块压缩文件内容
+#   merkle: 以分块摘要（Merkle 树叶子）代替整文件 MD5 校验，只重传损坏的分块
+#   mux: 同一对端的传输共用一条长连接，每个传输是其中一个通道，控制消息带长度前缀
+SUPPORTED_FEATURES = ['trailer', 'merkle', 'mux']
+MAX_PENDING_MANIFESTS = 16  # 最多保留这么多个等待对方接受的目录清单
+if hasattr(os, 'pwrite'):
+    SUPPORTED_FEATURES.append('ranges')
+if compression.available():
+    SUPPORTED_FEATURES.append('zstd')
 
 class TransferStatus(Enum):
     WAITING = "等待中"
@@ -20,114 +59,314 @@ class TransferInfo:
     md5: str
     operation: str
     status: TransferStatus = TransferStatus.WAITING
+    metrics: dict = field(default_factory=dict)  # 接收流水线各阶段的耗时
+
+@dataclass
+class TransferStats:
+    done: int  # 已传输字节数（含续传前已有的部分）
+    total: int
+    rate: float  # 最近一段时间的速率，字节/秒
+    average: float  # 本次传输开始以来的平均速率，字节/秒
+    eta: float  # 预计剩余秒数，速率未知时为 None
+
+    @property
+    def percent(self):
+        return int(self.done * 100 / self.total) if self.total else 100
+
+class TransferTelemetry:
+    """汇总收发线程上报的字节数，每个传输最多每 TELEMETRY_INTERVAL 秒发出一次统计
+
+    收发循环每个数据块都会调用，直接发 Qt 信号会让跨线程事件堆满 GUI 队列；
+    这里只在锁内累加计数，到采样时间或传输结束时才回调 emit。
+    """
+
+    def __init__(self, emit, total):
+        self.emit = emit
+        self.total = total
+        self.lock = threading.Lock()
+        self.done = 0
+        self.base = 0  # 续传前已有的字节数，不计入速率
+        self.start = self.last_time = time.monotonic()
+        self.last_done = 0
+        self.rate = 0.0
+
+    def resume(self, n):
+        with self.lock:
+            self.done += n
+            self.base += n
+            self.last_done = self.done
+        self.report(force=True)
+
+    def __call__(self, n):
+        with self.lock:
+            self.done += n
+        self.report()
+
+    def report(self, force=False):
+        with self.lock:
+            now = time.monotonic()
+            finished = self.done >= self.total
+            if not force and not finished and now - self.last_time < TELEMETRY_INTERVAL:
+                return
+            if finished and self.last_done >= self.total and not force:
+                return  # 结束时的统计已经发过
+            elapsed = now - self.last_time
+            if elapsed > 0 and self.done > self.last_done:
+                sample = (self.done - self.last_done) / elapsed
+                self.rate = sample if not self.rate else \
+                    RATE_SMOOTHING * sample + (1 - RATE_SMOOTHING) * self.rate
+            self.last_time, self.last_done = now, self.done
+            duration = now - self.start
+            done = min(self.done, self.total)
+            average = (self.done - self.base) / duration if duration > 0 else 0.0
+            remaining = self.total - done
+            eta = 0.0 if not remaining else (remaining / self.rate if self.rate else None)
+            # 在锁内发出，保证多个数据连接上报时统计按时间顺序到达
+            self.emit(TransferStats(done, self.total, self.rate, average, eta))
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise Exception("连接已断开")
+        data.extend(chunk)
+    return bytes(data)
+
+MESSAGE_HEADER = struct.Struct('!I')
+
+def send_message(sock, message):
+    """发送带长度前缀的 JSON 消息，用于长度不定的控制消息（如分块摘要列表）"""
+    data = json.dumps(message).encode()
+    sock.sendall(MESSAGE_HEADER.pack(len(data)) + data)
+
+def recv_message(sock):
+    size, = MESSAGE_HEADER.unpack(recv_exact(sock, MESSAGE_HEADER.size))
+    return json.loads(recv_exact(sock, size).decode())
+
+def send_control(sock, message):
+    """发送握手等控制消息：复用连接的通道上带长度前缀，旧版每文件一条的连接仍是裸 JSON"""
+    if isinstance(sock, mux.Channel):
+        send_message(sock, message)
+    else:
+        sock.send(json.dumps(message).encode())
+
+def recv_control(sock):
+    if isinstance(sock, mux.Channel):
+        return recv_message(sock)
+    return json.loads(sock.recv(1024).decode())
+
+def peer_closed(sock):
+    """对方已关闭连接且没有待读数据时返回 True，不会阻塞"""
+    if isinstance(sock, mux.Channel):
+        return sock.remote_closed()
+    readable, _, _ = select.select([sock], [], [], 0)
+    return bool(readable) and not sock.recv(1, socket.MSG_PEEK)
+
+def load_transfer_settings(path='settings.json'):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('transfer', {})
+    except Exception:
+        return {}
 
 class FileTransferServer(QObject):
-    transfer_progress = Signal(str, str, int)  # filename, operation, progress
+    transfer_progress = Signal(str, str, object)  # filename, operation, TransferStats
     transfer_complete = Signal(str, str)  # filename, operation
     transfer_error = Signal(str, str, str)  # filename, operation, error_message
     transfer_status = Signal(str, TransferStatus)  # filename, status
     
     def __init__(self):
         super().__init__()
+        # 缓冲区大小以 KB 为单位配置：
+        #   {"transfer": {"recv_buffer_size": 1024, "socket_buffer_size": 0, "fsync": false}}
+        settings = load_transfer_settings()
+        self.recv_buffer_size = int(settings.get('recv_buffer_size', 0)) * 1024 or RECV_BUFFER_SIZE
+        self.fsync = bool(settings.get('fsync', False))  # 接收完成、改名之前把文件刷到磁盘
+        socket_buffer_size = int(settings.get('socket_buffer_size', 0)) * 1024 or SOCKET_BUFFER_SIZE
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if socket_buffer_size:
+            # 必须在 listen 之前设置，接受的连接继承该值并据此协商窗口缩放
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, socket_buffer_size)
         self.server.bind(('0.0.0.0', 15001))
         self.server.listen(5)
         self.active_transfers = {}  # {filename: TransferInfo}
         self.cancel_flags = set()  # 存储需要取消的传输文件名
         self.save_paths = {}  # {filename: save_path}
+        self.peer_features = {}  # {ip: set(features)}
+        self.hash_cache = HashCache()
+        self.range_sessions = {}  # {transfer_id: RangeReceiveSession}
+        self.batch_manifests = OrderedDict()  # {(目录, target_ip): (dirs, files)}，发送请求时生成的清单
+        self.pool = mux.PeerPool(15001)  # 到各对端的复用连接
         
-        # 启动接收服务器线程
-        self.accept_thread = None
+        # 接收和发送都由同一个传输引擎调度，发送的排队顺序和限速由调度器决定
+        self.scheduler = TransferScheduler.from_settings()
+        self.engine = TransferEngine(
+            streams_per_transfer=MAX_STREAMS,
+            max_sends=self.scheduler.max_active_sends
+        )
         self.running = True
         
     def __del__(self):
+        # 构造中途失败（如端口被占用）时后面的属性还不存在，不要掩盖原来的错误
         self.running = False
-        if self.server:
-            self.server.close()
+        pool = getattr(self, 'pool', None)
+        if pool is not None:
+            pool.close_all()
+        engine = getattr(self, 'engine', None)
+        if engine is not None:
+            engine.stop()
+        server = getattr(self, 'server', None)
+        if server:
+            server.close()
             
     def start_receiving(self):
-        def accept_connections():
-            while self.running:
-                try:
-                    client, addr = self.server.accept()
-                    # 为每个客户端创建新线程处理
-                    client_thread = QThread()
-                    client_thread.run = lambda: self.handle_client(client, addr)
-                    client_thread.start()
-                except Exception as e:
-                    if self.running:  # 只在非正常关闭时打印错误
-                        print(f"Error accepting connection: {e}")
-                    break
-                    
-        self.accept_thread = QThread()
-        self.accept_thread.run = accept_connections
-        self.accept_thread.start()
+        self.engine.serve(self.server, self.handle_client)
         
     def calculate_md5(self, filename):
+        return self.hash_cache.get_or_compute(filename, self.compute_md5)
+
+    def compute_md5(self, filename):
         hash_md5 = hashlib.md5()
         with open(filename, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
+            for chunk in iter(lambda: f.read(BUFFER_SIZE), b""):
                 hash_md5.update(chunk)
         return hash_md5.hexdigest()
         
     def send_file(self, filename, target_ip):
+        if os.path.isdir(filename):
+            self.send_batch(filename, target_ip)
+            return
         try:
             print(f"Starting to send file: {filename} to {target_ip}")  # 调试信息
-            # 准备传输信息
+            # 准备传输信息，MD5 不在调用线程（GUI）中计算
             file_size = os.path.getsize(filename)
-            md5 = self.calculate_md5(filename)
             base_filename = os.path.basename(filename)
             
             transfer_info = TransferInfo(
                 filename=base_filename,
                 size=file_size,
-                md5=md5,
+                md5='',
                 operation='send'
             )
             self.active_transfers[base_filename] = transfer_info
+            # 排队等待发送名额期间显示等待中
+            self.transfer_status.emit(base_filename, TransferStatus.WAITING)
             
             def transfer():
                 try:
+                    # 命中摘要缓存时直接放在文件信息里，走零拷贝发送；
+                    # 对方不支持摘要尾部时只能先完整计算一遍MD5
+                    # 对方支持分块校验时不需要 MD5，叶子摘要在发送的同时由线程池计算
+                    file_stat = os.stat(filename)
+                    features = self.peer_features.get(target_ip, ())
+                    use_merkle = 'merkle' in features
+                    md5 = None if use_merkle else self.hash_cache.get(filename)
+                    use_ranges = 'ranges' in features and file_size >= PARALLEL_MIN_SIZE
+                    use_trailer = not md5 and not use_ranges and not use_merkle and 'trailer' in features
+                    use_zstd = (not use_ranges and 'zstd' in features
+                                and compression.worth_compressing(self.read_sample(filename)))
+                    # 多连接传输时摘要在发送数据的同时计算，发完后再告知接收方
+                    if not md5 and not use_trailer and not use_ranges and not use_merkle:
+                        md5 = self.compute_md5(filename)
+                        self.hash_cache.put(filename, md5, st=file_stat)
+                    transfer_info.md5 = md5 or ''
+                    
                     print(f"Connecting to {target_ip}:15001")  # 调试信息
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                        s.settimeout(30)
-                        s.connect((target_ip, 15001))
+                    with self.open_connection(target_ip) as s:
                         
                         # 发送文件信息
                         info = {
                             'filename': base_filename,
                             'size': file_size,
-                            'md5': md5
+                            'md5': md5,
+                            # 接收方据此判断已有的 .part 文件是否属于同一文件
+                            'file_id': f"{file_stat.st_size}:{file_stat.st_mtime_ns}"
                         }
-                        s.send(json.dumps(info).encode())
+                        if use_trailer:
+                            info['digest'] = 'trailer'
+                        if use_merkle:
+                            info['digest'] = 'merkle'
+                        if use_ranges:
+                            info['streams'] = MAX_STREAMS
+                        if use_zstd:
+                            info['compression'] = 'zstd'
+                        send_control(s, info)
                         
                         # 等待确认
-                        response = json.loads(s.recv(1024).decode())
+                        response = recv_control(s)
                         if response.get('status') == 'rejected':
                             raise Exception("接收方拒绝接收文件")
+                        elif response.get('status') == 'error':
+                            raise Exception(f"接收方出错: {response.get('error')}")
                         elif response.get('status') != 'ready':
                             raise Exception("接收方未准备好")
+                        if use_trailer and response.get('digest') != 'trailer':
+                            raise Exception("接收方不支持摘要尾部")
+                        if use_merkle and response.get('digest') != 'merkle':
+                            raise Exception("接收方不支持分块校验")
                         
                         transfer_info.status = TransferStatus.TRANSFERRING
                         self.transfer_status.emit(base_filename, TransferStatus.TRANSFERRING)
                         
+                        # 接收方已有部分数据时从其要求的偏移续传
+                        offset = response.get('offset', 0)
+                        if offset:
+                            print(f"Resuming {base_filename} from offset {offset}")  # 调试信息
+                        
+                        if use_merkle:
+                            cached_leaves = self.hash_cache.get(filename, 'merkle')
+                            leaf_futures = None if cached_leaves else merkle.submit_leaves(filename, file_size)
+                        
                         # 发送文件内容
-                        sent = 0
-                        with open(filename, 'rb') as f:
-                            while sent < file_size:
-                                if base_filename in self.cancel_flags:
-                                    raise Exception("传输已取消")
-                                    
-                                chunk = f.read(8192)
-                                if not chunk:
-                                    break
-                                s.send(chunk)
-                                sent += len(chunk)
-                                progress = int((sent / file_size) * 100)
-                                self.transfer_progress.emit(base_filename, 'send', progress)
+                        if response.get('streams'):
+                            md5 = self.send_ranges(
+                                s, filename, target_ip, file_size, md5,
+                                response['transfer_id'], response['streams'], offset,
+                                need_md5=not use_merkle
+                            )
+                            if not use_merkle:
+                                transfer_info.md5 = md5
+                                self.hash_cache.put(filename, md5, st=file_stat)
+                                send_control(s, {'status': 'sent', 'md5': md5})
+                        elif use_ranges and not md5:
+                            raise Exception("接收方未接受多连接传输")
+                        else:
+                            progress = self.progress_reporter(base_filename, 'send', file_size)
+                            progress.resume(offset)
+                            with open(filename, 'rb') as f:
+                                if use_trailer:
+                                    # 续传时接收方已有的部分也要计入摘要
+                                    hash_md5 = hashlib.md5()
+                                    while f.tell() < offset:
+                                        hash_md5.update(f.read(min(BUFFER_SIZE, offset - f.tell())))
+                                    self.send_stream(
+                                        s, f, base_filename, file_size - offset, response,
+                                        hash_md5, progress
+                                    )
+                                    transfer_info.md5 = hash_md5.hexdigest()
+                                    s.sendall(hash_md5.digest())
+                                    self.hash_cache.put(filename, transfer_info.md5, st=file_stat)
+                                else:
+                                    f.seek(offset)
+                                    self.send_stream(
+                                        s, f, base_filename, file_size - offset, response,
+                                        progress=progress
+                                    )
                         
-                        # 等待接收方确认MD5
-                        verify_result = json.loads(s.recv(1024).decode())
+                        if use_merkle:
+                            if cached_leaves:
+                                leaves = json.loads(cached_leaves)
+                            else:
+                                leaves = [future.result() for future in leaf_futures]
+                                self.hash_cache.put(filename, json.dumps(leaves), 'merkle', file_stat)
+                            root = merkle.merkle_root(leaves)
+                            transfer_info.md5 = root
+                            send_message(s, {'status': 'sent', 'leaves': leaves, 'root': root})
+                            verify_result = self.serve_repairs(s, filename, file_size)
+                        else:
+                            # 等待接收方确认MD5
+                            verify_result = recv_control(s)
                         if verify_result.get('md5_match'):
                             transfer_info.status = TransferStatus.COMPLETED
                             self.transfer_status.emit(base_filename, TransferStatus.COMPLETED)
@@ -148,68 +387,512 @@ class FileTransferServer(QObject):
                     if base_filename in self.cancel_flags:
                         self.cancel_flags.remove(base_filename)
                     
-            self.transfer_thread = QThread()
-            self.transfer_thread.run = transfer
-            self.transfer_thread.start()
+            self.engine.submit(transfer, priority=self.scheduler.priority(file_size))
             
         except Exception as e:
             print(f"Error in send_file: {e}")  # 调试信息
             self.transfer_error.emit(base_filename, 'send', str(e))
     
+    def set_batch_manifest(self, root, target_ip, manifest):
+        """记录发送目录请求时生成的清单，对方接受后 send_batch 直接使用"""
+        self.batch_manifests[root, target_ip] = manifest
+        while len(self.batch_manifests) > MAX_PENDING_MANIFESTS:
+            self.batch_manifests.popitem(last=False)
+
+    def send_batch(self, root, target_ip):
+        """把整个目录作为一个传输，经一条连接依次发送其中所有文件
+
+        连接建立后先发送目录清单，之后每个文件以 FILE_HEADER 开头，内容之后跟 MD5 尾部；
+        小文件写入带缓冲的连接，多个文件合并为一次发送，大文件仍走零拷贝。
+        """
+        batch_name = os.path.basename(os.path.normpath(root))
+        try:
+            print(f"Starting to send folder: {root} to {target_ip}")  # 调试信息
+            # 发送请求时已在后台生成清单，这里不再遍历目录；没有时在传输线程中遍历
+            manifest = self.batch_manifests.pop((root, target_ip), None)
+            transfer_info = TransferInfo(
+                filename=batch_name,
+                size=sum(entry['size'] for entry in manifest[1]) if manifest else 0,
+                md5='',
+                operation='send'
+            )
+            self.active_transfers[batch_name] = transfer_info
+            self.transfer_status.emit(batch_name, TransferStatus.WAITING)
+
+            def transfer():
+                try:
+                    dirs, files = manifest if manifest is not None else batch.build_manifest(root)
+                    total_size = transfer_info.size = sum(entry['size'] for entry in files)
+                    with self.open_connection(target_ip) as s:
+                        send_control(s, {
+                            'filename': batch_name,
+                            'batch': True,
+                            'count': len(files),
+                            'size': total_size
+                        })
+
+                        response = recv_control(s)
+                        if response.get('status') == 'rejected':
+                            raise Exception("接收方拒绝接收文件")
+                        elif response.get('status') != 'ready':
+                            raise Exception("接收方未准备好")
+                        send_message(s, {'dirs': dirs, 'files': files})
+
+                        transfer_info.status = TransferStatus.TRANSFERRING
+                        self.transfer_status.emit(batch_name, TransferStatus.TRANSFERRING)
+                        progress = self.progress_reporter(batch_name, 'send', total_size)
+                        peer = s.getpeername()[0]
+                        with s.makefile('wb', buffering=BUFFER_SIZE) as writer:
+                            for index, entry in enumerate(files):
+                                if batch_name in self.cancel_flags:
+                                    raise Exception("传输已取消")
+                                path = os.path.join(root, *entry['path'].split('/'))
+                                with open(path, 'rb') as f:
+                                    size = os.fstat(f.fileno()).st_size
+                                    if size != entry['size']:
+                                        raise Exception(f"文件在发送前被修改: {entry['path']}")
+                                    if size <= batch.SMALL_FILE_SIZE:
+                                        data = f.read(size)
+                                        self.scheduler.throttle(peer, size)
+                                        writer.write(batch.FILE_HEADER.pack(index, size))
+                                        writer.write(data)
+                                        writer.write(hashlib.md5(data).digest())
+                                        progress(size)
+                                        continue
+                                    # 大文件：命中摘要缓存时零拷贝发送，否则边发送边计算
+                                    md5 = self.hash_cache.get(path)
+                                    hasher = None if md5 else hashlib.md5()
+                                    writer.write(batch.FILE_HEADER.pack(index, size))
+                                    writer.flush()
+                                    if self.send_payload(s, f, batch_name, size, hasher, progress) != size:
+                                        raise Exception(f"文件在发送过程中被修改: {entry['path']}")
+                                    if hasher is not None:
+                                        md5 = hasher.hexdigest()
+                                        self.hash_cache.put(path, md5)
+                                    writer.write(bytes.fromhex(md5))
+                            writer.write(batch.FILE_HEADER.pack(batch.END_OF_BATCH, 0))
+                            writer.flush()
+
+                        verify_result = recv_message(s)
+                        if verify_result.get('md5_match'):
+                            transfer_info.status = TransferStatus.COMPLETED
+                            self.transfer_status.emit(batch_name, TransferStatus.COMPLETED)
+                            self.transfer_complete.emit(batch_name, 'send')
+                        else:
+                            failed = verify_result.get('failed', [])
+                            raise Exception(f"{len(failed)} 个文件校验失败")
+
+                except Exception as e:
+                    print(f"Error in batch transfer: {e}")  # 调试信息
+                    if batch_name in self.cancel_flags:
+                        transfer_info.status = TransferStatus.CANCELLED
+                        self.transfer_status.emit(batch_name, TransferStatus.CANCELLED)
+                    else:
+                        transfer_info.status = TransferStatus.ERROR
+                        self.transfer_status.emit(batch_name, TransferStatus.ERROR)
+                        self.transfer_error.emit(batch_name, 'send', str(e))
+                finally:
+                    if batch_name in self.cancel_flags:
+                        self.cancel_flags.remove(batch_name)
+
+            self.engine.submit(transfer, priority=self.scheduler.priority(transfer_info.size))
+
+        except Exception as e:
+            print(f"Error in send_batch: {e}")  # 调试信息
+            self.transfer_error.emit(batch_name, 'send', str(e))
+
+    def send_payload(self, s, f, filename, file_size, hasher=None, progress=None):
+        """从 f 的当前位置开始发送 file_size 字节，优先走内核零拷贝
+
+        传入 hasher 时数据必须经过用户态，改为边读边更新摘要边发送
+        """
+        if progress is None:
+            progress = self.progress_reporter(filename, 'send', file_size)
+        peer = s.getpeername()[0]
+        window = self.scheduler.window(peer, SENDFILE_WINDOW)
+        sent = 0
+        if hasher is None and self.can_sendfile(f):
+            offset = f.tell()
+            try:
+                while sent < file_size:
+                    if filename in self.cancel_flags:
+                        raise Exception("传输已取消")
+                    count = min(window, file_size - sent)
+                    self.scheduler.throttle(peer, count)
+                    n = s.sendfile(f, offset + sent, count)
+                    if not n:
+                        break
+                    sent += n
+                    progress(n)
+                return sent
+            except OSError:
+                # 内核不支持该类文件的 sendfile 且尚未发出数据时回退到缓冲发送
+                if sent:
+                    raise
+                f.seek(offset)
+
+        buffer = memoryview(bytearray(BUFFER_SIZE))
+        block_size = min(BUFFER_SIZE, window)
+        while sent < file_size:
+            if filename in self.cancel_flags:
+                raise Exception("传输已取消")
+            n = f.readinto(buffer[:min(block_size, file_size - sent)])
+            if not n:
+                break
+            self.scheduler.throttle(peer, n)
+            chunk = buffer[:n]
+            if hasher is not None:
+                hasher.update(chunk)
+            s.sendall(chunk)
+            sent += n
+            progress(n)
+        return sent
+
+    def send_stream(self, s, f, filename, size, response, hasher=None, progress=None):
+        """单连接发送文件内容，接收方同意压缩时按块压缩，否则直接发送"""
+        if response.get('compression') != 'zstd':
+            return self.send_payload(s, f, filename, size, hasher, progress)
+
+        compressor = compression.BlockCompressor()
+        peer = s.getpeername()[0]
+        sent = 0
+        while sent < size:
+            if filename in self.cancel_flags:
+                raise Exception("传输已取消")
+            block = f.read(min(compression.BLOCK_SIZE, size - sent))
+            if not block:
+                break
+            if hasher is not None:
+                hasher.update(block)
+            # 按实际发出的压缩后字节数限速
+            self.scheduler.throttle(peer, compressor.send_block(s, block))
+            sent += len(block)
+            progress(len(block))
+        print(f"Compressed {filename}: ratio {compressor.ratio():.2f}, level {compressor.level}")  # 调试信息
+        return sent
+
+    def serve_repairs(self, s, filename, file_size):
+        """分块校验模式下按接收方的要求重传损坏的分块，返回最终的校验结果"""
+        base_filename = os.path.basename(filename)
+        while True:
+            message = recv_message(s)
+            if message.get('status') != 'repair':
+                return message
+            print(f"Resending {len(message['chunks'])} chunks of {base_filename}")  # 调试信息
+            with open(filename, 'rb') as f:
+                for index in message['chunks']:
+                    offset, length = merkle.leaf_range(index, file_size)
+                    f.seek(offset)
+                    self.send_payload(s, f, base_filename, length, progress=lambda n: None)
+
+    def repair_chunks(self, client, manifest, expected, filename):
+        """对比叶子摘要，只让发送方重传不一致的分块；返回修复后是否全部一致"""
+        actual = manifest.leaves()
+        bad = merkle.mismatched(actual, expected)
+        if len(actual) != len(expected):
+            return False
+        rounds = 0
+        while bad and rounds < merkle.MAX_REPAIR_ROUNDS:
+            rounds += 1
+            print(f"Requesting {len(bad)} damaged chunks of {filename}")  # 调试信息
+            send_message(client, {'status': 'repair', 'chunks': bad})
+            with open(manifest.part_path, 'r+b') as f:
+                for index in bad:
+                    offset, length = merkle.leaf_range(index, manifest.size)
+                    f.seek(offset)
+                    while length > 0:
+                        if filename in self.cancel_flags:
+                            raise Exception("传输已取消")
+                        chunk = client.recv(min(BUFFER_SIZE, length))
+                        if not chunk:
+                            raise Exception("连接已断开")
+                        f.write(chunk)
+                        length -= len(chunk)
+            pool = merkle.get_pool()
+            futures = {
+                index: pool.submit(merkle.hash_range, manifest.part_path,
+                                   *merkle.leaf_range(index, manifest.size))
+                for index in bad
+            }
+            bad = [index for index in bad if futures[index].result() != expected[index]]
+        return not bad
+
+    def read_sample(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read(compression.SAMPLE_SIZE)
+
+    def can_sendfile(self, f):
+        if not hasattr(os, 'sendfile'):
+            return False
+        try:
+            f.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            return False
+        return True
+
+    def progress_reporter(self, filename, operation, total):
+        """返回一个可被多个线程调用的进度回调，按时间采样后发出 transfer_progress"""
+        return TransferTelemetry(
+            lambda stats: self.transfer_progress.emit(filename, operation, stats), total
+        )
+
+    def send_ranges(self, s, filename, target_ip, file_size, md5, transfer_id, streams, offset=0,
+                    need_md5=True):
+        """经多条数据连接并行发送文件，返回文件的 MD5
+
+        摘要未知时在当前线程顺序计算，与各数据连接的发送重叠进行
+        """
+        base_filename = os.path.basename(filename)
+        progress = self.progress_reporter(base_filename, 'send', file_size)
+        progress.resume(offset)
+
+        def open_stream():
+            # 数据段需要真正并行的 TCP 连接，不走复用连接
+            stream = socket.create_connection((target_ip, 15001), timeout=30)
+            try:
+                send_control(stream, {
+                    'filename': base_filename,
+                    'transfer_id': transfer_id
+                })
+                if recv_control(stream).get('status') != 'ready':
+                    raise Exception("接收方拒绝数据连接")
+            except Exception:
+                stream.close()
+                raise
+            return stream
+
+        def send_segment(stream, offset, length):
+            stream.sendall(SEGMENT_HEADER.pack(offset, length))
+            with open(filename, 'rb') as f:
+                f.seek(offset)
+                self.send_payload(stream, f, base_filename, length, progress=on_progress)
+
+        def on_progress(n):
+            sender.record(n)
+            progress(n)
+
+        sender = RangeSender(
+            file_size, streams, open_stream, send_segment,
+            lambda: base_filename in self.cancel_flags, offset
+        )
+        sender.start()
+        if not md5 and need_md5:
+            md5 = self.compute_md5(filename)
+        sender.join()
+        return md5
+
+    def open_connection(self, target_ip):
+        """支持复用连接的对端在共享连接上新开一个通道，旧版对端每个文件一条连接"""
+        if 'mux' in self.peer_features.get(target_ip, ()):
+            try:
+                channel = self.pool.open_channel(target_ip)
+                channel.settimeout(30)
+                return channel
+            except OSError as e:
+                print(f"Multiplexed connection to {target_ip} failed: {e}")  # 调试信息
+        return socket.create_connection((target_ip, 15001), timeout=30)
+
     def set_save_path(self, filename, save_path):
         self.save_paths[filename] = save_path
 
-    def handle_client(self, client, addr):
+    def set_peer_features(self, ip, features):
+        self.peer_features[ip] = set(features)
+
+    async def handle_client(self, client, addr):
+        # 在事件循环中读取文件信息，不为尚未完成握手的连接占用线程
+        loop = asyncio.get_running_loop()
+        try:
+            data = await asyncio.wait_for(loop.sock_recv(client, 1024), 30)
+            while data and len(data) < len(mux.MAGIC) and mux.MAGIC.startswith(data):
+                data += await asyncio.wait_for(loop.sock_recv(client, 1024), 30)
+            if data.startswith(mux.MAGIC):
+                # 复用连接：之后每个通道各自是一次传输
+                client.setblocking(True)
+                mux.enable_keepalive(client)
+                mux.PeerConnection(client, self.accept_channel, data[len(mux.MAGIC):])
+                return
+            info = json.loads(data.decode())
+        except Exception as e:
+            print(f"Error reading transfer info from {addr}: {e}")
+            client.close()
+            return
+        
+        client.setblocking(True)
+        await self.dispatch(client, info)
+
+    def accept_channel(self, channel):
+        # 在连接的读取线程中调用，交给事件循环处理
+        self.engine.loop.call_soon_threadsafe(self.engine.spawn, self.handle_channel(channel))
+
+    async def handle_channel(self, channel):
+        channel.settimeout(30)
+        try:
+            info = await self.engine.run_stream(recv_message, channel)
+        except Exception as e:
+            print(f"Error reading transfer info from {channel.getpeername()}: {e}")
+            channel.close()
+            return
+        channel.settimeout(None)
+        await self.dispatch(channel, info)
+
+    async def dispatch(self, client, info):
+        # 多连接传输的数据连接携带 transfer_id，其余为文件传输的控制连接
+        if 'transfer_id' in info:
+            await self.engine.run_stream(self.handle_range_stream, client, info)
+        elif info.get('batch'):
+            await self.engine.run_transfer('receive', self.receive_batch, client, info)
+        else:
+            await self.engine.run_transfer('receive', self.receive_file, client, info)
+
+    def receive_file(self, client, info):
+        session = None
+        manifest = None
+        ready = False  # 是否已回应 ready；之前出错时告诉发送方原因
         try:
-            # 接收文件信息
-            info = json.loads(client.recv(1024).decode())
             filename = info['filename']
             file_size = info['size']
-            expected_md5 = info['md5']
+            expected_md5 = info.get('md5')
+            use_trailer = info.get('digest') == 'trailer'
+            use_merkle = info.get('digest') == 'merkle'
+            # 带文件标识的发送方支持续传，出错时保留 .part 文件和分块清单
+            resumable = bool(info.get('file_id'))
             
             # 获取保存路径，如果没有设置则拒绝接收
             if filename not in self.save_paths:
-                client.send(json.dumps({'status': 'rejected'}).encode())
+                send_control(client, {'status': 'rejected'})
                 return
             
-            save_path = self.save_paths[filename]
+            # 先登记传输，打开 .part 文件失败（如保存目录不可写）时和其他接收错误一样报告
             transfer_info = TransferInfo(
                 filename=filename,
                 size=file_size,
-                md5=expected_md5,
+                md5=expected_md5 or '',
                 operation='receive'
             )
             self.active_transfers[filename] = transfer_info
+            save_path = self.save_paths[filename]
+            part_path = f"{save_path}.part"
+            manifest = ChunkManifest(
+                part_path, info.get('file_id'), file_size,
+                pool=merkle.get_pool() if use_merkle else None
+            )
+            offset = manifest.resume()
             
             # 发送准备就绪确认
-            client.send(json.dumps({'status': 'ready'}).encode())
+            response = {'status': 'ready'}
+            if use_trailer:
+                response['digest'] = 'trailer'
+            if use_merkle:
+                response['digest'] = 'merkle'
+            if resumable:
+                response['offset'] = offset
+            compressed = info.get('compression') == 'zstd' and compression.available()
+            if compressed:
+                response['compression'] = 'zstd'
+            progress = self.progress_reporter(filename, 'receive', file_size)
+            progress.resume(offset)
+            if info.get('streams') and 'ranges' in SUPPORTED_FEATURES:
+                session = RangeReceiveSession(
+                    filename, part_path, file_size, progress, truncate=not offset
+                )
+                transfer_id = uuid.uuid4().hex
+                self.range_sessions[transfer_id] = session
+                response['streams'] = min(info['streams'], MAX_STREAMS)
+                response['transfer_id'] = transfer_id
+            send_control(client, response)
+            ready = True
             
             transfer_info.status = TransferStatus.TRANSFERRING
             self.transfer_status.emit(filename, TransferStatus.TRANSFERRING)
             
-            # 接收文件内容
-            received = 0
-            hash_md5 = hashlib.md5()
+            # 接收文件内容，整文件 MD5（或分块校验的叶子）与分块摘要都由分块清单维护
+            received = offset
             
-            with open(save_path, 'wb') as f:  # 使用用户指定的保存路径
-                while received < file_size:
+            if session is not None:
+                # 数据由各数据连接写入，这里按顺序对写完的部分计算摘要
+                def check():
                     if filename in self.cancel_flags:
                         raise Exception("传输已取消")
-                        
-                    chunk = client.recv(8192)
-                    if not chunk:
-                        break
-                    
-                    hash_md5.update(chunk)
-                    f.write(chunk)
-                    received += len(chunk)
-                    progress = int((received / file_size) * 100)
-                    self.transfer_progress.emit(filename, 'receive', progress)
+                    if peer_closed(client):
+                        raise Exception("发送方已断开")
+                
+                if use_merkle:
+                    session.wait_in_order(lambda start, length: manifest.advance(length), check, offset)
+                else:
+                    session.hash_in_order(manifest, check, BUFFER_SIZE, offset)
+                    sent_info = recv_control(client)
+                    expected_md5 = sent_info.get('md5')
+                    transfer_info.md5 = expected_md5 or ''
+                if self.fsync:
+                    os.fsync(session.fd)
+            else:
+                if compressed:
+                    decompressor = compression.BlockDecompressor(lambda n: recv_exact(client, n))
+                
+                # 网络读取、写文件和摘要分别在流水线的三个阶段中重叠进行；
+                # 数据直接收进流水线的缓冲区，写文件和摘要都使用同一个 memoryview，不产生副本
+                with open(part_path, 'r+b' if offset else 'wb') as f:
+                    f.seek(offset)
+                    f.truncate()
+                    manifest.flush = f.flush
+                    stages = pipeline.ReceivePipeline(f, manifest, self.recv_buffer_size, self.fsync)
+                    try:
+                        while received < file_size:
+                            if filename in self.cancel_flags:
+                                raise Exception("传输已取消")
+                            
+                            start = time.perf_counter()
+                            if compressed:
+                                buffer = None
+                                chunk = decompressor.read_block()
+                            else:
+                                buffer = stages.buffer()
+                                start = time.perf_counter()
+                                # 不能多读，文件内容之后可能紧跟摘要尾部
+                                n = client.recv_into(buffer, min(len(buffer), file_size - received))
+                                chunk = buffer[:n]
+                            if not chunk:
+                                break
+                            if len(chunk) > file_size - received:
+                                raise Exception("接收到的数据超出文件大小")
+                            
+                            stages.received(chunk, buffer, time.perf_counter() - start)
+                            received += len(chunk)
+                            progress(len(chunk))
+                    finally:
+                        stages.finish()
+                        transfer_info.metrics = stages.summary()
+                        print(f"Receive pipeline {filename}: {transfer_info.metrics}, "
+                              f"bottleneck: {stages.bottleneck()}")  # 调试信息
+                
+                if received < file_size:
+                    raise Exception("连接已断开")
+            
+            if use_trailer:
+                expected_md5 = recv_exact(client, manifest.hasher.digest_size).hex()
+                transfer_info.md5 = expected_md5
             
-            # 验证MD5
-            actual_md5 = hash_md5.hexdigest()
-            md5_match = actual_md5 == expected_md5
-            client.send(json.dumps({'md5_match': md5_match}).encode())
+            if use_merkle:
+                # 分块校验：叶子列表须与根摘要一致，不一致的分块单独重传
+                sent_info = recv_message(client)
+                expected_leaves = sent_info['leaves']
+                transfer_info.md5 = sent_info['root']
+                md5_match = (merkle.merkle_root(expected_leaves) == sent_info['root']
+                             and self.repair_chunks(client, manifest, expected_leaves, filename))
+            else:
+                # 验证MD5
+                actual_md5 = manifest.hasher.hexdigest()
+                md5_match = actual_md5 == expected_md5
+            if md5_match:
+                manifest.remove(keep_part=True)
+                os.replace(part_path, save_path)
+            else:
+                # 无法判断是哪个分块出错，不再保留未完成的文件
+                resumable = False
+            if use_merkle:
+                send_message(client, {'md5_match': md5_match})
+            else:
+                send_control(client, {'md5_match': md5_match})
             
             if md5_match:
                 transfer_info.status = TransferStatus.COMPLETED
@@ -219,6 +902,13 @@ class FileTransferServer(QObject):
                 raise Exception("文件校验失败")
                 
         except Exception as e:
+            if session is not None:
+                session.fail(e)
+            if not ready:
+                try:
+                    send_control(client, {'status': 'error', 'error': str(e)})
+                except Exception:
+                    pass
             if filename in self.cancel_flags:
                 transfer_info.status = TransferStatus.CANCELLED
                 self.transfer_status.emit(filename, TransferStatus.CANCELLED)
@@ -227,19 +917,175 @@ class FileTransferServer(QObject):
                 self.transfer_status.emit(filename, TransferStatus.ERROR)
                 self.transfer_error.emit(filename, 'receive', str(e))
             
-            # 清理未完成的文件
-            try:
-                if os.path.exists(save_path):
-                    os.remove(save_path)
-            except:
-                pass
+            # 连接中断时保留未完成的文件以便续传，取消或无法续传时清理
+            if manifest is not None:
+                if resumable and filename not in self.cancel_flags:
+                    print(f"Keeping partial file for resume: {manifest.part_path}")  # 调试信息
+                    try:
+                        manifest.drain(wait=True)  # 记下线程池中已提交分块的摘要
+                    except Exception:
+                        pass
+                    manifest.close()
+                else:
+                    manifest.remove()
                 
         finally:
+            if manifest is not None:
+                manifest.close()
+            if session is not None:
+                for transfer_id, item in list(self.range_sessions.items()):
+                    if item is session:
+                        del self.range_sessions[transfer_id]
+                session.release()
             if filename in self.save_paths:
                 del self.save_paths[filename]  # 清理保存路径
             if filename in self.cancel_flags:
                 self.cancel_flags.remove(filename)
             client.close()
     
+    def receive_batch(self, client, info):
+        """接收 send_batch 发来的目录，在保存路径下按清单重建目录结构"""
+        batch_name = info['filename']
+        total_size = info['size']
+        transfer_info = TransferInfo(
+            filename=batch_name,
+            size=total_size,
+            md5='',
+            operation='receive'
+        )
+        reader = None
+        part_path = None
+        try:
+            if batch_name not in self.save_paths:
+                send_control(client, {'status': 'rejected'})
+                return
+            self.active_transfers[batch_name] = transfer_info
+            root = batch.local_path(self.save_paths[batch_name], batch_name)
+            send_control(client, {'status': 'ready'})
+
+            manifest = recv_message(client)
+            files = manifest['files']
+            # 先检查所有路径，避免写入一部分后才发现非法路径
+            paths = [batch.local_path(root, entry['path']) for entry in files]
+            for rel_dir in manifest['dirs']:
+                os.makedirs(batch.local_path(root, rel_dir), exist_ok=True)
+            os.makedirs(root, exist_ok=True)
+
+            transfer_info.status = TransferStatus.TRANSFERRING
+            self.transfer_status.emit(batch_name, TransferStatus.TRANSFERRING)
+            progress = self.progress_reporter(batch_name, 'receive', total_size)
+            reader = client.makefile('rb', buffering=BUFFER_SIZE)
+            buffer = memoryview(bytearray(BUFFER_SIZE))
+            failed = []
+            received_files = 0
+
+            def read_exact(size):
+                data = reader.read(size)
+                if len(data) < size:
+                    raise Exception("连接已断开")
+                return data
+
+            while True:
+                index, size = batch.FILE_HEADER.unpack(read_exact(batch.FILE_HEADER.size))
+                if index == batch.END_OF_BATCH:
+                    break
+                if index >= len(files) or size != files[index]['size']:
+                    raise Exception("文件头与目录清单不一致")
+
+                path = paths[index]
+                part_path = f"{path}.part"
+                hash_md5 = hashlib.md5()
+                with open(part_path, 'wb') as f:
+                    remaining = size
+                    while remaining:
+                        if batch_name in self.cancel_flags:
+                            raise Exception("传输已取消")
+                        n = reader.readinto(buffer[:min(BUFFER_SIZE, remaining)])
+                        if not n:
+                            raise Exception("连接已断开")
+                        chunk = buffer[:n]
+                        hash_md5.update(chunk)
+                        f.write(chunk)
+                        remaining -= n
+                        progress(n)
+                if read_exact(hash_md5.digest_size) == hash_md5.digest():
+                    os.replace(part_path, path)
+                else:
+                    os.remove(part_path)
+                    failed.append(files[index]['path'])
+                part_path = None
+                received_files += 1
+
+            if received_files < len(files):
+                raise Exception("部分文件未发送")
+            send_message(client, {'md5_match': not failed, 'failed': failed})
+            if failed:
+                raise Exception(f"{len(failed)} 个文件校验失败")
+            transfer_info.status = TransferStatus.COMPLETED
+            self.transfer_status.emit(batch_name, TransferStatus.COMPLETED)
+            self.transfer_complete.emit(batch_name, 'receive')
+
+        except Exception as e:
+            print(f"Error receiving batch: {e}")  # 调试信息
+            if part_path is not None and os.path.exists(part_path):
+                os.remove(part_path)
+            if batch_name in self.cancel_flags:
+                transfer_info.status = TransferStatus.CANCELLED
+                self.transfer_status.emit(batch_name, TransferStatus.CANCELLED)
+            else:
+                transfer_info.status = TransferStatus.ERROR
+                self.transfer_status.emit(batch_name, TransferStatus.ERROR)
+                self.transfer_error.emit(batch_name, 'receive', str(e))
+
+        finally:
+            if reader is not None:
+                reader.close()
+            if batch_name in self.save_paths:
+                del self.save_paths[batch_name]
+            if batch_name in self.cancel_flags:
+                self.cancel_flags.remove(batch_name)
+            client.close()
+
+    def handle_range_stream(self, client, info):
+        session = self.range_sessions.get(info['transfer_id'])
+        if session is None or not session.acquire():
+            send_control(client, {'status': 'rejected'})
+            client.close()
+            return
+        
+        try:
+            send_control(client, {'status': 'ready'})
+            buffer = memoryview(bytearray(BUFFER_SIZE))
+            while True:
+                # 连接在数据段边界处关闭表示该连接的数据已发送完毕
+                header = client.recv(SEGMENT_HEADER.size)
+                if not header:
+                    break
+                if len(header) < SEGMENT_HEADER.size:
+                    header += recv_exact(client, SEGMENT_HEADER.size - len(header))
+                offset, length = SEGMENT_HEADER.unpack(header)
+                if offset + length > session.size:
+                    raise Exception("数据段超出文件范围")
+                
+                received = 0
+                while received < length:
+                    if session.filename in self.cancel_flags:
+                        raise Exception("传输已取消")
+                    if session.error is not None:
+                        raise session.error
+                    n = client.recv_into(buffer, min(BUFFER_SIZE, length - received))
+                    if not n:
+                        raise Exception("连接已断开")
+                    session.write(offset + received, buffer[:n])
+                    received += n
+                    session.progress(n)
+                session.add_segment(offset, length)
+        except Exception as e:
+            print(f"Error in range stream: {e}")  # 调试信息
+            session.fail(e)
+        finally:
+            session.release()
+            client.close()
+    
     def cancel_transfer(self, filename):
         self.cancel_flags.add(filename) 
\ No newline at end of file
@@ -0,0 +1,110 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+
+SAVE_DELAY = 5  # 新条目最多等这么久写入磁盘，期间的多次记录合并为一次写入
+
+class HashCache:
+    """文件摘要的持久化缓存
+
+    以 (算法, 设备号, inode, 大小, mtime_ns) 为键，文件内容不变时重复发送无需再次计算摘要。
+    条目按最近使用顺序淘汰，最多保留 max_entries 条。记录新条目后延迟 SAVE_DELAY 秒写入，
+    退出时调用 close 写入尚未保存的条目。
+    """
+
+    def __init__(self, path='hash_cache.json', max_entries=1024):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # {key: digest}，末尾为最近使用
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # 多个传输线程同时保存时依次写入
+        self.dirty = False
+        self.timer = None
+        self.load()
+
+    @staticmethod
+    def make_key(st, algorithm='md5'):
+        return f"{algorithm}:{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+    def get(self, filename, algorithm='md5'):
+        try:
+            key = self.make_key(os.stat(filename), algorithm)
+        except OSError:
+            return None
+        with self.lock:
+            digest = self.entries.get(key)
+            if digest is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return digest
+
+    def put(self, filename, digest, algorithm='md5', st=None):
+        """记录摘要；st 为开始计算前的 stat 结果，文件在计算期间被修改则不缓存"""
+        try:
+            current = os.stat(filename)
+        except OSError:
+            return
+        key = self.make_key(current, algorithm)
+        if st is not None and self.make_key(st, algorithm) != key:
+            return
+        with self.lock:
+            self.entries[key] = digest
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+            if self.timer is None:
+                self.timer = threading.Timer(SAVE_DELAY, self.save)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def get_or_compute(self, filename, compute, algorithm='md5'):
+        digest = self.get(filename, algorithm)
+        if digest is None:
+            st = os.stat(filename)
+            digest = compute(filename)
+            self.put(filename, digest, algorithm, st)
+        return digest
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            self.entries = OrderedDict(entries[-self.max_entries:])
+        except Exception:
+            self.entries = OrderedDict()
+
+    def save(self):
+        # 先写临时文件再替换，避免崩溃时留下损坏的缓存
+        with self.save_lock:
+            with self.lock:
+                self.timer = None
+                if not self.dirty:
+                    return
+                self.dirty = False
+                entries = list(self.entries.items())
+            tmp_path = f"{self.path}.tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(entries, f)
+                os.replace(tmp_path, self.path)
+                print(f"Hash cache saved: {self.stats()}")  # 调试信息
+            except Exception as e:
+                print(f"Error saving hash cache: {e}")
+
+    def close(self):
+        """取消延迟保存并立即写入尚未保存的条目"""
+        with self.lock:
+            timer = self.timer
+        if timer is not None:
+            timer.cancel()
+        self.save()
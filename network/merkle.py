@@ -0,0 +1,50 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from network.resume import CHUNK_SIZE, chunk_hasher, hash_range
+
+LEAF_SIZE = CHUNK_SIZE  # 叶子与续传分块一致，分块清单里的摘要就是叶子
+MAX_REPAIR_ROUNDS = 3  # 重传损坏分块的最多轮数
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """收发两端共用的摘要线程池，大小与 CPU 核数一致"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 4,
+                                       thread_name_prefix='merkle')
+        return _pool
+
+def leaf_range(index, size):
+    offset = index * LEAF_SIZE
+    return offset, min(LEAF_SIZE, size - offset)
+
+def submit_leaves(path, size):
+    """把每个叶子的计算分别提交到线程池，返回按顺序排列的 future 列表"""
+    pool = get_pool()
+    return [
+        pool.submit(hash_range, path, *leaf_range(index, size))
+        for index in range((size + LEAF_SIZE - 1) // LEAF_SIZE)
+    ]
+
+def merkle_root(leaves):
+    level = [bytes.fromhex(leaf) for leaf in leaves]
+    if not level:
+        return chunk_hasher().hexdigest()
+    while len(level) > 1:
+        parents = []
+        for i in range(0, len(level), 2):
+            node = chunk_hasher()
+            node.update(level[i])
+            if i + 1 < len(level):
+                node.update(level[i + 1])
+            parents.append(node.digest())
+        level = parents
+    return level[0].hex()
+
+def mismatched(actual, expected):
+    return [index for index, leaf in enumerate(expected)
+            if index >= len(actual) or actual[index] != leaf]
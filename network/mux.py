@@ -0,0 +1,405 @@
+import io
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+MAGIC = b'PYIPMUX1'  # 复用连接建立后发送的前导字节，旧版连接的第一条消息以 JSON 开头
+FRAME_HEADER = struct.Struct('!BII')  # type, channel_id, length
+OPEN, DATA, CLOSE, WINDOW = range(4)
+MAX_FRAME = 1024 * 1024  # 单个数据帧的最大长度，多个通道按帧轮流发送
+CHANNEL_WINDOW = 8 * 1024 * 1024  # 每个通道未被读取的数据上限
+SMALL_FRAME = 64 * 1024  # 小帧与帧头合并后一次发送
+CONNECT_TIMEOUT = 30
+IDLE_TIMEOUT = 60  # 没有通道的连接空闲多久后关闭
+REAP_INTERVAL = 5
+
+def enable_keepalive(sock):
+    """复用连接长期存在，靠 TCP keepalive 发现已经消失的对端"""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for name, value in (('TCP_KEEPIDLE', 30), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 3)):
+        if hasattr(socket, name):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+class Channel:
+    """复用连接上的一个双向通道，提供传输代码用到的套接字接口
+
+    接收的数据由连接的读取线程放入缓冲区；发送受对方窗口限制，对方读取后通过 WINDOW 帧归还额度，
+    一个通道的接收方处理得慢不会阻塞同一连接上的其他通道。
+    """
+
+    def __init__(self, connection, channel_id):
+        self.connection = connection
+        self.id = channel_id
+        self.cond = threading.Condition()
+        self.chunks = deque()  # 尚未读取的数据，元素为 memoryview
+        self.consumed = 0  # 上次归还窗口后读取的字节数
+        self.send_window = CHANNEL_WINDOW
+        self.eof = False  # 对方已关闭通道
+        self.error = None
+        self.closed = False
+        self.timeout = None
+
+    # 以下由连接的读取线程调用
+    def feed(self, data):
+        with self.cond:
+            self.chunks.append(data)
+            self.cond.notify_all()
+
+    def feed_window(self, credit):
+        with self.cond:
+            self.send_window += credit
+            self.cond.notify_all()
+
+    def feed_eof(self):
+        with self.cond:
+            self.eof = True
+            self.cond.notify_all()
+
+    def fail(self, error):
+        with self.cond:
+            self.error = error
+            self.cond.notify_all()
+
+    def wait(self, predicate):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while not predicate():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise socket.timeout("timed out")
+            self.cond.wait(remaining)
+
+    def recv_into(self, buffer, nbytes=0):
+        view = memoryview(buffer).cast('B')
+        size = nbytes or len(view)
+        credit = 0
+        with self.cond:
+            self.wait(lambda: self.chunks or self.eof or self.error is not None or self.closed)
+            if not self.chunks:
+                if self.error is not None:
+                    raise self.error
+                return 0
+            filled = 0
+            while self.chunks and filled < size:
+                chunk = self.chunks[0]
+                n = min(len(chunk), size - filled)
+                view[filled:filled + n] = chunk[:n]
+                if n == len(chunk):
+                    self.chunks.popleft()
+                else:
+                    self.chunks[0] = chunk[n:]
+                filled += n
+            self.consumed += filled
+            if self.consumed >= CHANNEL_WINDOW // 2 and not self.eof:
+                credit, self.consumed = self.consumed, 0
+        if credit:
+            self.connection.send_frame(WINDOW, self.id, length=credit)
+        return filled
+
+    def recv(self, size):
+        buffer = bytearray(size)
+        n = self.recv_into(buffer, size)
+        return bytes(buffer[:n])
+
+    def reserve(self, size):
+        """等待对方窗口，返回本次可发送的字节数"""
+        with self.cond:
+            self.wait(lambda: self.send_window > 0 or self.eof
+                      or self.error is not None or self.closed)
+            if self.error is not None:
+                raise self.error
+            if self.eof or self.closed:
+                raise ConnectionResetError("通道已关闭")
+            n = min(size, self.send_window, MAX_FRAME)
+            self.send_window -= n
+            return n
+
+    def sendall(self, data):
+        view = memoryview(data).cast('B')
+        while view:
+            n = self.reserve(len(view))
+            self.connection.send_frame(DATA, self.id, view[:n])
+            view = view[n:]
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def sendfile(self, file, offset=0, count=None):
+        """数据帧的内容直接由内核从文件发出，与普通套接字的 sendfile 一样返回发送的字节数"""
+        sent = 0
+        while sent < count:
+            n = self.reserve(count - sent)
+            self.connection.send_file_frame(self.id, file, offset + sent, n)
+            sent += n
+        return sent
+
+    def makefile(self, mode='rb', buffering=io.DEFAULT_BUFFER_SIZE):
+        raw = ChannelIO(self, mode)
+        if 'r' in mode:
+            return io.BufferedReader(raw, buffering)
+        return io.BufferedWriter(raw, buffering)
+
+    def remote_closed(self):
+        with self.cond:
+            return self.error is not None or (self.eof and not self.chunks)
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def setblocking(self, flag):
+        self.timeout = None if flag else 0
+
+    def getpeername(self):
+        return self.connection.peer
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        self.connection.close_channel(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class ChannelIO(io.RawIOBase):
+    """供 makefile() 使用，关闭文件对象不会关闭通道"""
+
+    def __init__(self, channel, mode):
+        self.channel = channel
+        self.mode = mode
+
+    def readable(self):
+        return 'r' in self.mode
+
+    def writable(self):
+        return 'w' in self.mode
+
+    def readinto(self, buffer):
+        return self.channel.recv_into(buffer)
+
+    def write(self, data):
+        self.channel.sendall(data)
+        return len(data)
+
+class PeerConnection:
+    """一条承载多个通道的 TCP 连接
+
+    通道只由发起连接的一方打开；接受连接的一方在收到 OPEN 帧时调用 on_channel(channel)。
+    读取线程把数据帧分发到各通道，连接断开时所有通道都会收到错误。
+    """
+
+    def __init__(self, sock, on_channel=None, initial=b''):
+        self.sock = sock
+        self.peer = sock.getpeername()
+        self.on_channel = on_channel
+        self.channels = {}  # {channel_id: Channel}
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.next_id = 1
+        self.closed = False
+        self.last_active = time.monotonic()
+        self.pending = initial  # 识别连接类型时多读到的字节
+        self.thread = threading.Thread(target=self.read_loop, name='mux-reader', daemon=True)
+        self.thread.start()
+
+    def read_exact(self, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        filled = min(size, len(self.pending))
+        if filled:
+            view[:filled] = self.pending[:filled]
+            self.pending = self.pending[filled:]
+        while filled < size:
+            n = self.sock.recv_into(view[filled:])
+            if not n:
+                raise ConnectionResetError("连接已断开")
+            filled += n
+        return data
+
+    def read_loop(self):
+        try:
+            while True:
+                kind, channel_id, length = FRAME_HEADER.unpack(self.read_exact(FRAME_HEADER.size))
+                if kind == OPEN:
+                    self.accept_channel(channel_id)
+                    continue
+                if kind == DATA and length > MAX_FRAME:
+                    raise Exception("数据帧超出长度限制")
+                data = memoryview(self.read_exact(length)) if kind == DATA else None
+                with self.lock:
+                    channel = self.channels.get(channel_id)
+                if channel is None:
+                    continue  # 本端已关闭的通道
+                if kind == DATA:
+                    channel.feed(data)
+                elif kind == WINDOW:
+                    channel.feed_window(length)
+                elif kind == CLOSE:
+                    channel.feed_eof()
+        except Exception as e:
+            if not self.closed:
+                print(f"Multiplexed connection to {self.peer[0]} closed: {e}")  # 调试信息
+        finally:
+            self.close()
+
+    def accept_channel(self, channel_id):
+        channel = Channel(self, channel_id)
+        with self.lock:
+            self.channels[channel_id] = channel
+            self.last_active = time.monotonic()
+        if self.on_channel is None:
+            channel.close()
+        else:
+            self.on_channel(channel)
+
+    def open_channel(self):
+        with self.lock:
+            if self.closed:
+                raise ConnectionResetError("连接已断开")
+            channel_id = self.next_id
+            self.next_id += 1
+            channel = Channel(self, channel_id)
+            self.channels[channel_id] = channel
+            self.last_active = time.monotonic()
+        self.send_frame(OPEN, channel_id)
+        return channel
+
+    def close_channel(self, channel):
+        with self.lock:
+            self.channels.pop(channel.id, None)
+            self.last_active = time.monotonic()
+        try:
+            self.send_frame(CLOSE, channel.id)
+        except OSError:
+            pass
+
+    def send_frame(self, kind, channel_id, payload=b'', length=None):
+        header = FRAME_HEADER.pack(kind, channel_id, len(payload) if length is None else length)
+        with self.send_lock:
+            if self.closed:
+                raise ConnectionResetError("连接已断开")
+            try:
+                if len(payload) <= SMALL_FRAME:
+                    self.sock.sendall(header + bytes(payload))
+                else:
+                    self.sock.sendall(header)
+                    self.sock.sendall(payload)
+            except OSError:
+                self.close()  # 帧只发出一部分，连接上的数据已无法解析
+                raise
+
+    def send_file_frame(self, channel_id, file, offset, count):
+        with self.send_lock:
+            if self.closed:
+                raise ConnectionResetError("连接已断开")
+            try:
+                self.sock.sendall(FRAME_HEADER.pack(DATA, channel_id, count))
+                if self.sock.sendfile(file, offset, count) != count:
+                    raise OSError("文件在发送过程中被截断")
+            except OSError:
+                self.close()
+                raise
+
+    def close_if_idle(self, timeout):
+        with self.lock:
+            if self.closed or self.channels or time.monotonic() - self.last_active < timeout:
+                return self.closed
+            self.closed = True
+        self.shutdown()
+        return True
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                channels = []
+            else:
+                self.closed = True
+                channels = list(self.channels.values())
+            self.channels.clear()
+        for channel in channels:
+            channel.fail(ConnectionResetError("连接已断开"))
+        self.shutdown()
+
+    def shutdown(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+class PeerPool:
+    """发送方按对端 IP 保持的复用连接，空闲超过 idle_timeout 的连接由后台线程关闭"""
+
+    def __init__(self, port, idle_timeout=IDLE_TIMEOUT):
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.connections = {}  # {ip: PeerConnection}
+        self.lock = threading.Lock()
+        self.reaper = None
+
+    def open_channel(self, ip):
+        for _ in range(2):
+            with self.lock:
+                connection = self.connections.get(ip)
+            if connection is None or connection.closed:
+                connection = self.connect(ip)
+            try:
+                return connection.open_channel()
+            except ConnectionResetError:
+                continue  # 连接恰好被回收或已断开，重新建立
+        raise ConnectionResetError(f"无法建立到 {ip} 的复用连接")
+
+    def connect(self, ip):
+        sock = socket.create_connection((ip, self.port), timeout=CONNECT_TIMEOUT)
+        try:
+            sock.settimeout(None)
+            enable_keepalive(sock)
+            sock.sendall(MAGIC)
+        except OSError:
+            sock.close()
+            raise
+        connection = PeerConnection(sock)
+        with self.lock:
+            current = self.connections.get(ip)
+            if current is not None and not current.closed:
+                connection.close()  # 其他线程已经建好了连接
+                return current
+            self.connections[ip] = connection
+            self.start_reaper()
+        print(f"Opened multiplexed connection to {ip}")  # 调试信息
+        return connection
+
+    def start_reaper(self):
+        if self.reaper is None:
+            self.reaper = threading.Thread(target=self.reap_loop, name='mux-reaper', daemon=True)
+            self.reaper.start()
+
+    def reap_loop(self):
+        while True:
+            time.sleep(REAP_INTERVAL)
+            with self.lock:
+                connections = list(self.connections.items())
+            for ip, connection in connections:
+                if connection.close_if_idle(self.idle_timeout):
+                    with self.lock:
+                        if self.connections.get(ip) is connection:
+                            del self.connections[ip]
+                            print(f"Closed idle connection to {ip}")  # 调试信息
+
+    def close_all(self):
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+        for connection in connections:
+            connection.close()
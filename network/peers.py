@@ -0,0 +1,108 @@
+import heapq
+import threading
+import time
+
+class Peer:
+    """在线用户记录；deadline 为单调时钟下的过期时刻"""
+
+    __slots__ = ('ip', 'username', 'last_seen', 'timeout', 'deadline')
+
+    def __init__(self, ip, username, last_seen, timeout):
+        self.ip = ip
+        self.username = username
+        self.last_seen = last_seen
+        self.timeout = timeout
+        self.deadline = last_seen + timeout
+
+class PeerTable:
+    """线程安全的在线用户表
+
+    过期时刻放在最小堆中，每次检查只弹出已到期的条目，代价与过期人数成正比而不是在线人数。
+    用户刷新时不在堆中查找旧条目，而是压入新条目，弹出时与记录中的 deadline 不一致的视为作废；
+    作废条目过多时整体重建堆。
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.peers = {}  # {ip: Peer}
+        self.heap = []  # [(deadline, ip)]
+        self.lock = threading.Lock()
+        self.expired_total = 0
+        self.max_lateness = 0.0  # 实际移除时刻比过期时刻晚了多久，反映检查是否及时
+
+    def __len__(self):
+        return len(self.peers)
+
+    def __contains__(self, ip):
+        return ip in self.peers
+
+    def touch(self, ip, username, timeout):
+        """收到在线广播时调用，返回 (是否新上线, 用户名是否改变)"""
+        now = self.clock()
+        with self.lock:
+            peer = self.peers.get(ip)
+            if peer is None:
+                self.peers[ip] = peer = Peer(ip, username, now, timeout)
+                new, renamed = True, False
+            else:
+                renamed = peer.username != username
+                peer.username = username
+                peer.last_seen = now
+                peer.timeout = timeout
+                peer.deadline = now + timeout
+                new = False
+            heapq.heappush(self.heap, (peer.deadline, ip))
+            if len(self.heap) > 2 * len(self.peers) + 64:
+                self.compact()
+        return new, renamed
+
+    def remove(self, ip):
+        """对方通知离线时调用，堆中的条目留到弹出时丢弃"""
+        with self.lock:
+            return self.peers.pop(ip, None) is not None
+
+    def username(self, ip, default=None):
+        with self.lock:
+            peer = self.peers.get(ip)
+            return peer.username if peer is not None else default
+
+    def snapshot(self):
+        """返回 [(ip, 用户名)] 副本，可在锁外遍历"""
+        with self.lock:
+            return [(peer.ip, peer.username) for peer in self.peers.values()]
+
+    def expire(self):
+        """移除所有已过期的用户并返回其 IP 列表"""
+        now = self.clock()
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, ip = heapq.heappop(self.heap)
+                peer = self.peers.get(ip)
+                if peer is None or peer.deadline != deadline:
+                    continue
+                del self.peers[ip]
+                expired.append(ip)
+                self.max_lateness = max(self.max_lateness, now - deadline)
+            self.expired_total += len(expired)
+        return expired
+
+    def next_deadline(self):
+        """最近的过期时刻，可能属于已作废的条目，只会让检查提前"""
+        with self.lock:
+            return self.heap[0][0] if self.heap else None
+
+    def compact(self):
+        self.heap = [(peer.deadline, ip) for ip, peer in self.peers.items()]
+        heapq.heapify(self.heap)
+
+    def stats(self):
+        with self.lock:
+            next_expiry = self.heap[0][0] - self.clock() if self.heap else None
+            return {
+                'peers': len(self.peers),
+                'heap': len(self.heap),
+                'expired': self.expired_total,
+                'next_expiry': next_expiry,
+                'max_lateness': round(self.max_lateness, 3),
+            }
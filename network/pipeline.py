@@ -0,0 +1,108 @@
+import os
+import queue
+import threading
+import time
+
+RING_SIZE = 8  # 每个传输在各阶段之间流转的缓冲区个数，也是队列的容量
+
+class StageMetrics:
+    """一个阶段的耗时：busy 为实际工作时间，wait 为等待上游数据或下游空位的时间"""
+
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.wait = 0.0
+        self.items = 0
+
+    def as_dict(self):
+        return {'busy': round(self.busy, 3), 'wait': round(self.wait, 3), 'items': self.items}
+
+class ReceivePipeline:
+    """单连接接收的流水线：网络读取 -> 写文件 -> 摘要，三个阶段在不同线程中重叠执行
+
+    网络读取在调用者线程中进行，写文件和摘要各占一个线程，阶段之间是有界队列；
+    缓冲区在阶段间传递后回到空闲队列，空闲缓冲区用完时读取阶段等待，内存占用固定。
+    摘要在写入之后计算，分块清单记录的分块一定已经交给了文件对象。
+    """
+
+    def __init__(self, f, manifest, buffer_size, fsync=False):
+        self.f = f
+        self.manifest = manifest
+        self.fsync = fsync
+        self.free = queue.Queue()
+        for _ in range(RING_SIZE):
+            self.free.put(memoryview(bytearray(buffer_size)))
+        self.write_queue = queue.Queue(RING_SIZE)
+        self.hash_queue = queue.Queue(RING_SIZE)
+        self.error = None
+        self.metrics = {name: StageMetrics(name) for name in ('network', 'write', 'hash')}
+        self.threads = [
+            threading.Thread(target=self.run_stage, name='receive-write', daemon=True,
+                             args=(self.metrics['write'], self.write_queue, self.write, self.hash_queue)),
+            threading.Thread(target=self.run_stage, name='receive-hash', daemon=True,
+                             args=(self.metrics['hash'], self.hash_queue, self.manifest.update, None)),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def buffer(self):
+        """取一个空闲缓冲区，下游处理不过来时在这里等待"""
+        self.check()
+        start = time.perf_counter()
+        buffer = self.free.get()
+        self.metrics['network'].wait += time.perf_counter() - start
+        return buffer
+
+    def received(self, data, buffer=None, elapsed=0.0):
+        """把读到的数据交给写文件阶段；data 来自 buffer 时处理完后 buffer 回到空闲队列"""
+        network = self.metrics['network']
+        network.busy += elapsed
+        network.items += 1
+        start = time.perf_counter()
+        self.write_queue.put((data, buffer))
+        network.wait += time.perf_counter() - start
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, data):
+        self.f.write(data)
+
+    def run_stage(self, metrics, source, work, target):
+        while True:
+            start = time.perf_counter()
+            item = source.get()
+            metrics.wait += time.perf_counter() - start
+            if item is not None and self.error is None:
+                start = time.perf_counter()
+                try:
+                    work(item[0])
+                except Exception as e:
+                    self.error = e
+                metrics.busy += time.perf_counter() - start
+                metrics.items += 1
+            if target is not None:
+                start = time.perf_counter()
+                target.put(item)
+                metrics.wait += time.perf_counter() - start
+            elif item is not None and item[1] is not None:
+                self.free.put(item[1])
+            if item is None:
+                return
+
+    def finish(self):
+        """等待已收到的数据全部写入并计算摘要，按设置 fsync，阶段出错时抛出该错误"""
+        self.write_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.check()
+        self.f.flush()
+        if self.fsync:
+            os.fsync(self.f.fileno())
+
+    def bottleneck(self):
+        return max(self.metrics.values(), key=lambda metrics: metrics.busy).name
+
+    def summary(self):
+        return {name: metrics.as_dict() for name, metrics in self.metrics.items()}
@@ -0,0 +1,181 @@
+import os
+import struct
+import threading
+import time
+from collections import deque
+
+SEGMENT_SIZE = 16 * 1024 * 1024  # 每个数据段的大小
+PARALLEL_MIN_SIZE = 64 * 1024 * 1024  # 小于该大小的文件不值得多连接传输
+MAX_STREAMS = 8
+SEGMENT_HEADER = struct.Struct('!QQ')  # offset, length
+ADJUST_INTERVAL = 0.5  # 测量吞吐的间隔（秒）
+ADJUST_GAIN = 1.1  # 新增连接后吞吐提升超过 10% 才继续增加
+
+class RangeReceiveSession:
+    """一次多连接接收：预分配目标文件，各数据连接按偏移写入"""
+
+    def __init__(self, filename, path, size, progress, truncate=True):
+        self.filename = filename
+        self.path = path
+        self.size = size
+        self.progress = progress
+        flags = os.O_RDWR | os.O_CREAT | (os.O_TRUNC if truncate else 0)
+        self.fd = os.open(path, flags, 0o644)
+        self.preallocate()
+        self.cond = threading.Condition()
+        self.completed = {}  # {offset: length}，已完整写入、尚未计算摘要的数据段
+        self.error = None
+        self.refs = 1  # 控制连接和各数据连接都持有引用，全部释放后才关闭文件
+
+    def preallocate(self):
+        if self.size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.fd, 0, self.size)
+                return
+            except OSError:
+                pass  # 部分文件系统不支持，退回到 ftruncate
+        os.ftruncate(self.fd, self.size)
+
+    def write(self, offset, data):
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(self.fd, view, offset)
+            view = view[n:]
+            offset += n
+
+    def add_segment(self, offset, length):
+        with self.cond:
+            self.completed[offset] = length
+            self.cond.notify_all()
+
+    def fail(self, error):
+        with self.cond:
+            if self.error is None:
+                self.error = error
+            self.cond.notify_all()
+
+    def wait_in_order(self, consume, check, start=0):
+        """按文件顺序等待各数据段写完，对连续前缀调用 consume(offset, length)；check 用于检查取消和断线"""
+        frontier = start
+        while frontier < self.size:
+            with self.cond:
+                while frontier not in self.completed:
+                    if self.error is not None:
+                        raise self.error
+                    self.cond.wait(ADJUST_INTERVAL)
+                    check()
+                length = self.completed.pop(frontier)
+            consume(frontier, length)
+            frontier += length
+
+    def hash_in_order(self, hasher, check, buffer_size, start=0):
+        """对已写完的连续前缀计算摘要，与接收重叠进行"""
+        def consume(offset, length):
+            end = offset + length
+            while offset < end:
+                data = os.pread(self.fd, min(buffer_size, end - offset), offset)
+                if not data:
+                    raise Exception("读取已接收数据失败")
+                hasher.update(data)
+                offset += len(data)
+
+        self.wait_in_order(consume, check, start)
+
+    def acquire(self):
+        with self.cond:
+            if self.refs == 0 or self.error is not None:
+                return False
+            self.refs += 1
+            return True
+
+    def release(self):
+        with self.cond:
+            self.refs -= 1
+            if self.refs:
+                return
+        os.close(self.fd)
+
+class RangeSender:
+    """把文件切成数据段由多条连接并行发送
+
+    从一条连接开始，每隔 ADJUST_INTERVAL 测量总吞吐，只要新增连接还能明显提升吞吐
+    就继续增加，直到达到协商的连接数上限。
+    """
+
+    def __init__(self, file_size, max_streams, open_stream, send_segment, is_cancelled, start=0):
+        self.segments = deque(
+            (offset, min(SEGMENT_SIZE, file_size - offset))
+            for offset in range(start, file_size, SEGMENT_SIZE)
+        )
+        self.max_streams = max_streams
+        self.open_stream = open_stream
+        self.send_segment = send_segment
+        self.is_cancelled = is_cancelled
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.errors = []
+        self.workers = []
+        self.controller = None
+
+    def record(self, n):
+        with self.lock:
+            self.sent += n
+
+    def next_segment(self):
+        with self.lock:
+            if self.errors or not self.segments:
+                return None
+            return self.segments.popleft()
+
+    def start(self):
+        self.add_worker()
+        self.controller = threading.Thread(target=self.adjust, daemon=True)
+        self.controller.start()
+
+    def join(self):
+        self.controller.join()
+        for worker in list(self.workers):
+            worker.join()
+        if self.errors:
+            raise self.errors[0]
+        if self.segments:
+            raise Exception("数据段未发送完成")
+
+    def add_worker(self):
+        worker = threading.Thread(target=self.run_worker, daemon=True)
+        self.workers.append(worker)
+        worker.start()
+
+    def run_worker(self):
+        try:
+            with self.open_stream() as sock:
+                while True:
+                    if self.is_cancelled():
+                        raise Exception("传输已取消")
+                    segment = self.next_segment()
+                    if segment is None:
+                        break
+                    self.send_segment(sock, *segment)
+        except Exception as e:
+            with self.lock:
+                self.errors.append(e)
+
+    def adjust(self):
+        last_sent, last_time = 0, time.monotonic()
+        best_rate = 0
+        while any(worker.is_alive() for worker in self.workers):
+            time.sleep(ADJUST_INTERVAL)
+            now = time.monotonic()
+            with self.lock:
+                sent, remaining = self.sent, len(self.segments)
+            rate = (sent - last_sent) / (now - last_time)
+            last_sent, last_time = sent, now
+            if len(self.workers) >= self.max_streams or not remaining:
+                continue
+            if rate > best_rate * ADJUST_GAIN:
+                best_rate = rate
+                self.add_worker()
+            else:
+                # 吞吐不再随连接数增长，保持当前连接数
+                self.max_streams = len(self.workers)
+        print(f"Parallel transfer finished with {len(self.workers)} streams")  # 调试信息
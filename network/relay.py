@@ -0,0 +1,109 @@
+"""在线状态中继：汇总各网段客户端的在线广播，一次回应完整的在线列表
+
+用法: python -m network.relay [端口]
+
+客户端在设置中配置 {"discovery": {"relay": "主机:端口"}} 后，每次心跳额外向中继单播一次在线状态，
+其中带有上次收到的列表版本号；版本号不同时中继回应完整列表（按数据报大小分页），相同时只回应
+不含用户的确认，客户端据此刷新从中继得知的用户。
+"""
+import socket
+import sys
+import time
+
+from network import wire
+from network.peers import PeerTable
+
+RELAY_PORT = 15002
+MAX_DATAGRAM = 60000  # 每个回应的用户列表字段不超过该大小
+OFFLINE_TIMEOUT = 30
+APP_IDENTIFIER = "PyIPMSG"
+
+def roster_pages(version, entries):
+    """把 [(ip, 用户名, 间隔)] 编码为若干个 roster 数据报"""
+    pages = []
+    page = []
+    size = 0
+    for entry in entries:
+        entry_size = wire.ENTRY.size + len(entry[1].encode())
+        if page and size + entry_size > MAX_DATAGRAM:
+            pages.append(page)
+            page, size = [], 0
+        page.append(entry)
+        size += entry_size
+    pages.append(page)
+    return [wire.encode({'type': 'roster', 'version': version, 'peers': page}) for page in pages]
+
+class PresenceRelay:
+    """在线状态中继；用户表和过期处理与客户端共用 PeerTable"""
+
+    def __init__(self, host='0.0.0.0', port=RELAY_PORT):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.address = self.socket.getsockname()
+        self.peers = PeerTable()
+        self.intervals = {}  # {ip: 对方的广播间隔}
+        self.version = 0  # 有人上线、离线或改名时加一
+        self.running = True
+
+    def handle(self, data, addr):
+        msg, _ = wire.decode(data, APP_IDENTIFIER)
+        if msg is None or msg.get('type') != 'presence':
+            return
+        ip = addr[0]
+        if msg.get('status') == 'offline':
+            if self.peers.remove(ip):
+                self.intervals.pop(ip, None)
+                self.version += 1
+            return
+        interval = msg.get('interval') or 10
+        new, renamed = self.peers.touch(ip, msg.get('username', ''), max(OFFLINE_TIMEOUT, interval * 3))
+        self.intervals[ip] = interval
+        if new or renamed:
+            self.version += 1
+        if msg.get('roster_version') == self.version:
+            packets = [wire.encode({'type': 'roster', 'version': self.version, 'peers': []})]
+        else:
+            entries = [(ip, username, self.intervals.get(ip, 10)) for ip, username in self.peers.snapshot()]
+            packets = roster_pages(self.version, entries)
+        for packet in packets:
+            self.socket.sendto(packet, addr)
+
+    def expire(self):
+        expired = self.peers.expire()
+        for ip in expired:
+            self.intervals.pop(ip, None)
+        if expired:
+            self.version += 1
+            print(f"Relay expired {expired}, {self.peers.stats()}")  # 调试信息
+
+    def serve_forever(self):
+        while self.running:
+            deadline = self.peers.next_deadline()
+            self.socket.settimeout(1.0 if deadline is None else
+                                   min(1.0, max(0.01, deadline - time.monotonic())))
+            try:
+                data, addr = self.socket.recvfrom(65535)
+                self.handle(data, addr)
+            except socket.timeout:
+                pass
+            except OSError as e:
+                if not self.running:
+                    break
+                print(f"Relay error: {e}")
+            self.expire()
+
+    def stop(self):
+        self.running = False
+        self.socket.close()
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else RELAY_PORT
+    relay = PresenceRelay(port=port)
+    print(f"Presence relay listening on {relay.address}")
+    try:
+        relay.serve_forever()
+    except KeyboardInterrupt:
+        relay.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,409 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from network import wire
+
+MAX_DATAGRAM = 1472  # 以太网 MTU 减去 IP 和 UDP 包头，编码后的分片不超过该大小，避免 IP 分片
+FRAGMENT_SIZE = 1400  # 单发时每个分片的数据长度
+MIN_FRAGMENT_SIZE = 256  # 群发时接收方列表占用分片空间，数据长度不低于该值
+# chunk 消息除数据、群组名和接收方列表之外的长度：包头、6 个字段长度和 3 个整数字段
+CHUNK_OVERHEAD = wire.HEADER.size + 6 * wire.FIELD_LENGTH.size + 3 * wire.INT.size
+WINDOW = 64  # 每条消息同时在途的分片数
+ACK_EVERY = 8  # 按序收到这么多分片回应一次确认；乱序、重复和收齐时立即确认
+ACK_DELAY = 0.02  # 不足 ACK_EVERY 个的分片最多等这么久就确认，避免发送方超时重传
+BITMAP_SIZE = WINDOW * 2  # 确认中累计位置之后的分片位图覆盖的分片数
+INITIAL_RTO = 0.3
+MIN_RTO = 0.05
+MAX_RTO = 2.0
+BROADCAST_STALL = 1.0  # 群发接收方窗口已满且这么久（至少一个超时时间）没有确认进展时退出广播
+GIVE_UP = 15  # 这么久没有任何确认进展则发送失败
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+MAX_REASSEMBLY = 64 * 1024 * 1024  # 所有未收齐消息占用的内存上限，超出的分片直接丢弃
+SLOT_SIZE = 8  # 重组时每个分片槽位（列表中的一个引用）占用的内存，按分片数计入上限
+MAX_INCOMING_PER_PEER = 16  # 每个对端同时重组的消息数上限
+REASSEMBLY_TIMEOUT = 30  # 这么久没有收到新分片的未收齐消息被丢弃
+COMPLETED_MEMORY = 4096  # 记住最近收齐的消息，重传的分片只确认不重复投递
+PROGRESS_INTERVAL = 0.1
+
+def split(payload, size=FRAGMENT_SIZE):
+    return [payload[i:i + size] for i in range(0, len(payload), size)] or [b'']
+
+def fragment_size(group='', recipients=0):
+    """带上群组名和 recipients 个接收方地址（每个 4 字节）后分片仍不超过 MAX_DATAGRAM 的数据长度"""
+    return min(FRAGMENT_SIZE, MAX_DATAGRAM - CHUNK_OVERHEAD - len(group.encode()) - 4 * recipients)
+
+class Outgoing:
+    """发送给一个接收方的消息；sent 记录在途分片的发送时间和是否重传过
+
+    群发时每个接收方各有一个 Outgoing，共用分片列表；broadcast 为真时首次发送由 GroupSend 广播，
+    这里只负责单播重传，退出广播后剩下的分片改为单播发送。
+    """
+
+    __slots__ = ('ip', 'id', 'fragments', 'group', 'broadcast', 'acked', 'acked_count', 'base', 'next',
+                 'sent', 'rto', 'last_progress', 'reported')
+
+    def __init__(self, ip, message_id, fragments, rto, group=None):
+        self.ip = ip
+        self.id = message_id
+        self.fragments = fragments
+        self.group = group
+        self.broadcast = group is not None
+        self.acked = bytearray(len(self.fragments))
+        self.acked_count = 0
+        self.base = 0  # 第一个未确认的分片
+        self.next = 0  # 下一个首次发送的分片
+        self.sent = {}  # {index: (发送时间, 是否重传)}
+        self.rto = rto
+        self.last_progress = time.monotonic()
+        self.reported = 0.0
+
+class GroupSend:
+    """一次群发：分片广播一次，各接收方的确认和重传由各自的 Outgoing 处理"""
+
+    __slots__ = ('id', 'group', 'fragments', 'next', 'members')
+
+    def __init__(self, message_id, group, fragments, members):
+        self.id = message_id
+        self.group = group
+        self.fragments = fragments
+        self.next = 0
+        self.members = members
+
+class Incoming:
+    """重组中的消息；cumulative 为第一个缺失的分片，group 为群发的群组名"""
+
+    __slots__ = ('fragments', 'group', 'received', 'cumulative', 'size', 'last_seen', 'since_ack')
+
+    def __init__(self, count, group=''):
+        self.fragments = [None] * count
+        self.group = group
+        self.received = 0
+        self.cumulative = 0
+        self.size = count * SLOT_SIZE  # 已占用的内存：槽位加已收到的数据
+        self.last_seen = time.monotonic()
+        self.since_ack = 0
+
+class ReliableMessenger:
+    """在 UDP 上可靠地发送任意长度的消息
+
+    消息按 FRAGMENT_SIZE 分片，每条消息最多 WINDOW 个分片在途；接收方回应累计确认加位图，
+    发送方按往返时间估计的超时重传未确认的分片，超时后加倍。接收方按 (IP, 消息 ID) 去重，
+    重组占用的内存和等待时间都有上限。
+
+    send(data, ip) 发送一个消息字典，broadcast(data) 把消息字典发给整个网段，
+    deliver(ip, payload, group) 投递收齐的消息，
+    status(ip, message_id, state, done, total) 报告发送进度，state 为 sending/delivered/failed；
+    群发时每个接收方各报告一次。
+    """
+
+    def __init__(self, send, deliver, status, broadcast=None):
+        self.send = send
+        self.broadcast = broadcast
+        self.deliver = deliver
+        self.status = status
+        self.session = int.from_bytes(os.urandom(4), 'big') << 32  # 重启后消息 ID 不与之前的重复
+        self.counter = 0
+        self.outgoing = {}  # {(ip, message_id): Outgoing}
+        self.groups = {}  # {message_id: GroupSend}
+        self.incoming = {}  # {(ip, message_id): Incoming}
+        self.completed = OrderedDict()  # {(ip, message_id): 分片数}
+        self.buffered = 0
+        self.incoming_per_peer = {}  # {ip: 重组中的消息数}
+        self.rtt = {}  # {ip: (srtt, rttvar)}
+        self.counters = dict.fromkeys(('sent', 'retransmitted', 'duplicates', 'delivered',
+                                       'failed', 'expired', 'dropped'), 0)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='reliable-sender', daemon=True)
+        self.thread.start()
+
+    def send_message(self, ip, payload):
+        """排队发送并返回消息 ID，返回前先报告一次 sending"""
+        if len(payload) > MAX_MESSAGE_SIZE:
+            raise ValueError(f"message too large: {len(payload)} bytes")
+        with self.lock:
+            message_id = self.next_id()
+            message = self.outgoing[ip, message_id] = Outgoing(ip, message_id, split(payload), self.rto(ip))
+        self.report(message, 'sending')
+        self.wakeup.set()
+        return message_id
+
+    def send_group(self, ips, payload, group):
+        """群发：一份数据广播给所有接收方，只向没有确认的接收方单播重传"""
+        if len(payload) > MAX_MESSAGE_SIZE:
+            raise ValueError(f"message too large: {len(payload)} bytes")
+        # 广播的分片带有接收方列表，按人数缩小分片，单播重传共用同样的分片
+        size = fragment_size(group, len(ips))
+        if size < MIN_FRAGMENT_SIZE:
+            raise ValueError(f"too many recipients for one group send: {len(ips)}")
+        fragments = split(payload, size)
+        with self.lock:
+            message_id = self.next_id()
+            members = [Outgoing(ip, message_id, fragments, self.rto(ip), group) for ip in ips]
+            for member in members:
+                self.outgoing[member.ip, message_id] = member
+            self.groups[message_id] = GroupSend(message_id, group, fragments, members)
+        for member in members:
+            self.report(member, 'sending')
+        self.wakeup.set()
+        return message_id
+
+    def next_id(self):
+        self.counter += 1
+        return self.session | self.counter
+
+    def rto(self, ip):
+        if ip not in self.rtt:
+            return INITIAL_RTO
+        srtt, rttvar = self.rtt[ip]
+        return min(MAX_RTO, max(MIN_RTO, srtt + 4 * rttvar))
+
+    def sample_rtt(self, ip, sample):
+        if ip not in self.rtt:
+            self.rtt[ip] = (sample, sample / 2)
+        else:
+            srtt, rttvar = self.rtt[ip]
+            rttvar = 0.75 * rttvar + 0.25 * abs(srtt - sample)
+            self.rtt[ip] = (0.875 * srtt + 0.125 * sample, rttvar)
+
+    def send_fragment(self, message, index):
+        self.send({'type': 'chunk', 'id': message.id, 'index': index, 'count': len(message.fragments),
+                   'data': message.fragments[index], 'group': message.group}, message.ip)
+
+    def broadcast_fragments(self, group, now):
+        # 窗口已满且 BROADCAST_STALL 内没有确认进展的接收方退出广播，剩下的分片单独单播，
+        # 不让一个不回应的接收方拖住其他所有人；丢包时偶尔的停顿不会让接收方退出广播
+        members = []
+        for member in group.members:
+            if (member.ip, group.id) not in self.outgoing:
+                continue
+            if len(member.sent) >= WINDOW and now - member.last_progress > max(member.rto, BROADCAST_STALL):
+                member.broadcast = False
+                continue
+            members.append(member)
+        group.members = members
+        if not members:
+            del self.groups[group.id]
+            return
+        # 所有留在广播中的接收方都有空位时才广播下一个分片，各接收方按同一时刻开始计时
+        while (group.next < len(group.fragments)
+               and max(len(member.sent) for member in members) < WINDOW):
+            index = group.next
+            pending = [member for member in members if not member.acked[index]]
+            if pending:
+                self.broadcast({'type': 'chunk', 'id': group.id, 'index': index,
+                                'count': len(group.fragments), 'data': group.fragments[index],
+                                'group': group.group, 'recipients': [member.ip for member in pending]})
+                self.counters['sent'] += 1
+            for member in pending:
+                if not member.sent:
+                    member.last_progress = now  # 等待广播的时间不计入 GIVE_UP
+                member.sent[index] = (now, False)
+            for member in members:
+                member.next = index + 1
+            group.next += 1
+        if group.next == len(group.fragments):
+            del self.groups[group.id]  # 全部广播过，剩下的只是各接收方的单播重传
+            for member in members:
+                member.broadcast = False
+
+    def run(self):
+        while True:
+            self.wakeup.clear()
+            reports = []
+            now = time.monotonic()
+            due = now + 1.0
+            with self.lock:
+                for group in list(self.groups.values()):
+                    self.broadcast_fragments(group, now)
+                for message in list(self.outgoing.values()):
+                    # 分片都已确认、只在等待群发广播的接收方不算超时
+                    waiting = message.broadcast and not message.sent
+                    if not waiting and now - message.last_progress > GIVE_UP:
+                        del self.outgoing[message.ip, message.id]
+                        self.counters['failed'] += 1
+                        reports.append((message, 'failed'))
+                        continue
+                    # 超时只重传最早发出的一个分片作为探测，超时加倍；其余丢失的分片由确认中的位图发现后快速重传，
+                    # 避免一次延迟抖动让整个窗口（群发时乘以接收方人数）全部重发
+                    if message.sent:
+                        index, (sent_at, _) = min(message.sent.items(), key=lambda item: item[1][0])
+                        if now - sent_at >= message.rto:
+                            self.retransmit(message, index, now)
+                            message.rto = min(MAX_RTO, message.rto * 2)
+                    # 窗口有空位时发送新分片，仍在广播中的群发接收方由广播发送
+                    while (not message.broadcast and message.next < len(message.fragments)
+                           and len(message.sent) < WINDOW):
+                        if not message.acked[message.next]:
+                            self.send_fragment(message, message.next)
+                            message.sent[message.next] = (now, False)
+                            self.counters['sent'] += 1
+                        message.next += 1
+                    if message.sent:
+                        due = min(due, min(sent_at for sent_at, _ in message.sent.values()) + message.rto)
+                self.expire_incoming(now)
+                acks = self.delayed_acks(now)
+                for message in self.incoming.values():
+                    if message.since_ack:
+                        due = min(due, message.last_seen + ACK_DELAY)
+            for key, ack in acks:
+                self.send_ack(key, ack)
+            for message, state in reports:
+                self.report(message, state)
+            self.wakeup.wait(max(0, due - time.monotonic()))
+
+    def retransmit(self, message, index, now):
+        self.send_fragment(message, index)
+        message.sent[index] = (now, True)
+        self.counters['retransmitted'] += 1
+
+    def report(self, message, state):
+        self.status(message.ip, str(message.id), state, message.acked_count, len(message.fragments))
+
+    def handle_ack(self, ip, msg):
+        now = time.monotonic()
+        with self.lock:
+            message = self.outgoing.get((ip, msg['id']))
+            if message is None:
+                return
+            newly = []
+            for index in range(message.base, min(msg['received'], len(message.fragments))):
+                newly.append(index)
+            bitmap = msg.get('bitmap', b'')
+            for bit in range(len(bitmap) * 8):
+                if bitmap[bit // 8] & (0x80 >> bit % 8):
+                    newly.append(msg['received'] + bit)
+            progress = False
+            for index in newly:
+                if index >= len(message.fragments) or message.acked[index]:
+                    continue
+                message.acked[index] = 1
+                message.acked_count += 1
+                progress = True
+                sent = message.sent.pop(index, None)
+                if sent is not None and not sent[1]:
+                    self.sample_rtt(ip, now - sent[0])  # 重传过的分片不参与估计
+            while message.base < len(message.fragments) and message.acked[message.base]:
+                message.base += 1
+            if not progress:
+                return
+            # 比已确认的最高分片早发出、至今未确认，且超过一个往返时间的分片视为丢失
+            highest = max(index for index in newly if index < len(message.fragments))
+            srtt = self.rtt.get(ip, (INITIAL_RTO, 0))[0]
+            for index, (sent_at, _) in list(message.sent.items()):
+                if index < highest and now - sent_at >= srtt:
+                    self.retransmit(message, index, now)
+            message.last_progress = now
+            message.rto = self.rto(ip)
+            done = message.acked_count == len(message.fragments)
+            if done:
+                del self.outgoing[ip, message.id]
+                self.counters['delivered'] += 1
+            elif now - message.reported < PROGRESS_INTERVAL:
+                message = None
+            else:
+                message.reported = now
+        if message is not None:
+            self.report(message, 'delivered' if done else 'sending')
+        if not done:
+            self.wakeup.set()
+
+    def handle_chunk(self, ip, msg):
+        key = (ip, msg['id'])
+        count = msg['count']
+        index = msg['index']
+        payload = None
+        with self.lock:
+            if key in self.completed:
+                self.counters['duplicates'] += 1
+                ack = (self.completed[key], b'')
+            else:
+                message = self.incoming.get(key)
+                if message is None:
+                    if count <= 0 or count * MIN_FRAGMENT_SIZE > MAX_MESSAGE_SIZE + MIN_FRAGMENT_SIZE:
+                        return
+                    # 槽位在收到数据之前就已分配，先计入上限；每个对端同时重组的消息数也有上限
+                    if (self.buffered + count * SLOT_SIZE > MAX_REASSEMBLY
+                            or self.incoming_per_peer.get(ip, 0) >= MAX_INCOMING_PER_PEER):
+                        self.counters['dropped'] += 1
+                        return
+                    message = self.incoming[key] = Incoming(count, msg.get('group') or '')
+                    self.buffered += message.size
+                    self.incoming_per_peer[ip] = self.incoming_per_peer.get(ip, 0) + 1
+                if index >= len(message.fragments):
+                    return
+                data = msg['data']
+                message.last_seen = time.monotonic()
+                if message.fragments[index] is not None:
+                    self.counters['duplicates'] += 1
+                    ack = self.make_ack(message)
+                elif self.buffered + len(data) > MAX_REASSEMBLY:
+                    self.counters['dropped'] += 1
+                    return
+                else:
+                    in_order = index == message.cumulative
+                    message.fragments[index] = data
+                    message.received += 1
+                    message.size += len(data)
+                    message.since_ack += 1
+                    self.buffered += len(data)
+                    while (message.cumulative < len(message.fragments)
+                           and message.fragments[message.cumulative] is not None):
+                        message.cumulative += 1
+                    if message.received == len(message.fragments):
+                        self.remove_incoming(key, message)
+                        payload = b''.join(message.fragments)
+                        group = message.group
+                        self.completed[key] = len(message.fragments)
+                        while len(self.completed) > COMPLETED_MEMORY:
+                            self.completed.popitem(last=False)
+                        self.counters['delivered'] += 1
+                        ack = (len(message.fragments), b'')
+                    elif not in_order or message.since_ack >= ACK_EVERY:
+                        ack = self.make_ack(message)
+                    else:
+                        ack = None
+                        if message.since_ack == 1:
+                            self.wakeup.set()  # 发送线程在 ACK_DELAY 后补发确认
+        if ack is not None:
+            self.send_ack(key, ack)
+        if payload is not None:
+            self.deliver(ip, payload, group)
+
+    def send_ack(self, key, ack):
+        ip, message_id = key
+        self.send({'type': 'ack', 'id': message_id, 'received': ack[0], 'bitmap': ack[1]}, ip)
+
+    def delayed_acks(self, now):
+        return [(key, self.make_ack(message)) for key, message in self.incoming.items()
+                if message.since_ack and now - message.last_seen >= ACK_DELAY]
+
+    def make_ack(self, message):
+        message.since_ack = 0
+        bitmap = bytearray(BITMAP_SIZE // 8)
+        start = message.cumulative
+        for bit in range(min(BITMAP_SIZE, len(message.fragments) - start)):
+            if message.fragments[start + bit] is not None:
+                bitmap[bit // 8] |= 0x80 >> bit % 8
+        return start, bytes(bitmap) if any(bitmap) else b''
+
+    def expire_incoming(self, now):
+        for key, message in list(self.incoming.items()):
+            if now - message.last_seen > REASSEMBLY_TIMEOUT:
+                self.remove_incoming(key, message)
+                self.counters['expired'] += 1
+
+    def remove_incoming(self, key, message):
+        del self.incoming[key]
+        self.buffered -= message.size
+        ip = key[0]
+        self.incoming_per_peer[ip] -= 1
+        if not self.incoming_per_peer[ip]:
+            del self.incoming_per_peer[ip]
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, outgoing=len(self.outgoing), incoming=len(self.incoming),
+                        buffered=self.buffered)
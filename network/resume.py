@@ -0,0 +1,171 @@
+import os
+import json
+import hashlib
+from collections import deque
+
+CHUNK_SIZE = 16 * 1024 * 1024  # 续传的最小单位
+READ_SIZE = 1024 * 1024
+
+def chunk_hasher():
+    return hashlib.blake2b(digest_size=16)
+
+def hash_range(path, offset, length):
+    """计算文件中一段数据的分块摘要，hashlib 会释放 GIL，可在线程池中并行执行"""
+    chunk_hash = chunk_hasher()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            data = f.read(min(READ_SIZE, length))
+            if not data:
+                raise Exception("读取分块数据失败")
+            chunk_hash.update(data)
+            length -= len(data)
+    return chunk_hash.hexdigest()
+
+class ChunkManifest:
+    """未完成文件（.part）旁的分块清单，记录每个已完整接收的分块的摘要
+
+    清单第一行是文件标识，之后每行追加一个分块摘要；崩溃时最多丢失最后一行。
+    重新连接时逐块校验 .part 文件，从第一个缺失或损坏的分块开始续传。
+    update() 同时维护整个文件的 MD5，供最终校验使用。
+
+    传入线程池时不计算 MD5，分块摘要改为在数据写入 .part 文件后由线程池并行计算，
+    这些摘要即分块校验（Merkle 树）的叶子。
+    """
+
+    def __init__(self, part_path, file_id, size, chunk_size=CHUNK_SIZE, pool=None):
+        self.part_path = part_path
+        self.path = f"{part_path}.manifest"
+        self.file_id = file_id
+        self.size = size
+        self.chunk_size = chunk_size
+        self.digests = []
+        self.pool = pool
+        self.hasher = None if pool else hashlib.md5()
+        self.chunk_hash = chunk_hasher()
+        self.pending = deque()  # 线程池中尚未写入清单的分块摘要，按分块顺序排列
+        self.flush = None  # 提交分块前把缓冲区写入 .part 文件
+        self.position = 0
+        self.file = None
+
+    def load(self):
+        digests = []
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                header = json.loads(f.readline())
+                if header != self.header():
+                    return []
+                for line in f:
+                    entry = json.loads(line)
+                    if entry.get('index') != len(digests):
+                        break
+                    digests.append(entry['digest'])
+        except Exception:
+            pass  # 清单不存在、属于其他文件或最后一行写了一半
+        return digests
+
+    def resume(self):
+        """校验已有的分块并返回续传偏移，已校验的部分同时计入整文件 MD5"""
+        digests = self.load() if self.file_id else []
+        verified = []
+        if digests and os.path.exists(self.part_path) and self.pool:
+            futures = [
+                self.pool.submit(hash_range, self.part_path, *self.chunk_range(index))
+                for index in range(len(digests))
+            ]
+            for digest, future in zip(digests, futures):
+                if future.result() != digest:
+                    break
+                verified.append(digest)
+            for future in futures:
+                future.cancel()
+        elif digests and os.path.exists(self.part_path):
+            with open(self.part_path, 'rb') as f:
+                for index, digest in enumerate(digests):
+                    expected = min(self.chunk_size, self.size - index * self.chunk_size)
+                    data = f.read(expected)
+                    chunk_hash = chunk_hasher()
+                    chunk_hash.update(data)
+                    if len(data) != expected or chunk_hash.hexdigest() != digest:
+                        break
+                    self.hasher.update(data)
+                    verified.append(digest)
+        self.digests = verified
+        self.position = min(len(verified) * self.chunk_size, self.size)
+        self.rewrite()
+        return self.position
+
+    def chunk_range(self, index):
+        offset = index * self.chunk_size
+        return offset, min(self.chunk_size, self.size - offset)
+
+    def update(self, data):
+        if self.pool:
+            self.advance(len(data))
+            return
+        self.hasher.update(data)
+        view = memoryview(data)
+        while view:
+            room = self.chunk_size - self.position % self.chunk_size
+            part = view[:room]
+            self.chunk_hash.update(part)
+            self.position += len(part)
+            view = view[len(part):]
+            if self.position % self.chunk_size == 0 or self.position == self.size:
+                self.append(self.chunk_hash.hexdigest())
+                self.chunk_hash = chunk_hasher()
+
+    def advance(self, length):
+        """数据已写入 .part 文件，跨过分块边界时把该分块交给线程池计算摘要"""
+        target = self.position + length
+        while self.position < target:
+            index = self.position // self.chunk_size
+            offset, size = self.chunk_range(index)
+            if target < offset + size:
+                self.position = target
+                break
+            self.position = offset + size
+            if self.flush:
+                self.flush()
+            self.pending.append(self.pool.submit(hash_range, self.part_path, offset, size))
+        self.drain()
+
+    def drain(self, wait=False):
+        while self.pending and (wait or self.pending[0].done()):
+            self.append(self.pending.popleft().result())
+
+    def leaves(self):
+        self.drain(wait=True)
+        return list(self.digests)
+
+    def header(self):
+        return {'file_id': self.file_id, 'size': self.size, 'chunk_size': self.chunk_size}
+
+    def append(self, digest):
+        self.file.write(json.dumps({'index': len(self.digests), 'digest': digest}) + '\n')
+        self.file.flush()
+        self.digests.append(digest)
+
+    def rewrite(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.header()) + '\n')
+            for index, digest in enumerate(self.digests):
+                f.write(json.dumps({'index': index, 'digest': digest}) + '\n')
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def remove(self, keep_part=False):
+        self.close()
+        paths = [self.path] if keep_part else [self.path, self.part_path]
+        for path in paths:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError:
+                pass
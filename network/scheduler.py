@@ -0,0 +1,118 @@
+import asyncio
+import heapq
+import itertools
+import json
+import threading
+import time
+
+SMALL_FILE_SIZE = 8 * 1024 * 1024  # 小于该大小的文件优先发送
+MIN_WINDOW = 64 * 1024
+
+class TokenBucket:
+    """令牌桶限速，rate 为每秒字节数，0 表示不限速
+
+    consume() 先预扣令牌再按欠额休眠，多个线程同时发送时也能保持总速率。
+    """
+
+    def __init__(self, rate=0, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+class PrioritySlots:
+    """按优先级分配的有限名额，只在事件循环线程中使用
+
+    优先级数值小的先得到名额，同一优先级按提交顺序。
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiters = []  # [(priority, seq, future)]
+        self.counter = itertools.count()
+
+    async def acquire(self, priority=(0,)):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 已经分到名额后才被取消时要把名额让出去
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)  # 名额直接转给等待者，active 不变
+                return
+        self.active -= 1
+
+    def queued(self):
+        return sum(1 for _, _, future in self.waiters if not future.done())
+
+class TransferScheduler:
+    """发送调度：决定排队优先级，并对全局和单个对端的发送速率限速
+
+    限速配置从 settings.json 的 transfer 项读取，单位为 KB/s，0 表示不限速：
+        {"transfer": {"max_active_sends": 4, "max_upload_rate": 0, "max_peer_upload_rate": 0}}
+    """
+
+    def __init__(self, max_active_sends=4, max_upload_rate=0, max_peer_upload_rate=0):
+        self.max_active_sends = max_active_sends
+        self.global_bucket = TokenBucket(max_upload_rate * 1024)
+        self.peer_rate = max_peer_upload_rate * 1024
+        self.peer_buckets = {}  # {ip: TokenBucket}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, path='settings.json'):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                settings = json.load(f).get('transfer', {})
+            return cls(**{key: int(value) for key, value in settings.items()
+                          if key in ('max_active_sends', 'max_upload_rate', 'max_peer_upload_rate')})
+        except Exception:
+            return cls()
+
+    def priority(self, size):
+        """优先级分类：小文件在前，同类按提交顺序"""
+        return (0 if size < SMALL_FILE_SIZE else 1,)
+
+    def peer_bucket(self, ip):
+        with self.lock:
+            bucket = self.peer_buckets.get(ip)
+            if bucket is None:
+                bucket = TokenBucket(self.peer_rate)
+                self.peer_buckets[ip] = bucket
+            return bucket
+
+    def window(self, ip, window):
+        """限速时缩小每次发送的数据量，使休眠粒度约为 0.1 秒，取消也能及时生效"""
+        rates = [rate for rate in (self.global_bucket.rate, self.peer_rate) if rate]
+        if not rates:
+            return window
+        return max(MIN_WINDOW, min(window, int(min(rates) / 10)))
+
+    def throttle(self, ip, n):
+        self.global_bucket.consume(n)
+        self.peer_bucket(ip).consume(n)
@@ -0,0 +1,101 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from network.scheduler import PrioritySlots
+
+HANDSHAKE_WORKERS = 4  # 复用连接上读取握手的短任务，线程池被数据连接占满时仍能接受新传输
+
+class TransferEngine:
+    """文件传输引擎：一个 asyncio 事件循环线程负责接受连接、读取握手和调度传输
+
+    sendfile、pwrite 等收发本身是阻塞调用，放在有界线程池中执行。发送和接收各自限制
+    同时进行的传输数量（分开计数，避免双方互发时名额全被等待对方的发送占满），排队的发送
+    按优先级获得名额；多连接传输的数据连接属于已占用名额的传输，不再单独占用名额。
+
+    线程池只执行提交到这里的任务：发送和接收的主体、接收方的数据连接和握手。发送方的多连接
+    发送（RangeSender）、接收流水线的写入和摘要阶段、复用连接的读取各自使用独立的线程，不计入线程池。
+    """
+
+    def __init__(self, max_transfers=8, streams_per_transfer=8, max_sends=None):
+        self.max_transfers = max_transfers
+        self.max_sends = max_sends or max_transfers
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_sends + max_transfers * (streams_per_transfer + 1) + HANDSHAKE_WORKERS,
+            thread_name_prefix='transfer'
+        )
+        self.loop = asyncio.new_event_loop()
+        self.slots = {}  # {'send'/'receive': PrioritySlots}，在事件循环线程中使用
+        self.tasks = set()
+        self.thread = None
+        self.started = threading.Event()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run_loop, name='transfer-engine', daemon=True)
+        self.thread.start()
+        self.started.wait()
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.slots = {
+            'send': PrioritySlots(self.max_sends),
+            'receive': PrioritySlots(self.max_transfers),
+        }
+        self.loop.call_soon(self.started.set)
+        self.loop.run_forever()
+
+    def stop(self):
+        if self.thread is None:
+            return
+
+        def shutdown():
+            for task in list(self.tasks):
+                task.cancel()
+            self.loop.stop()
+
+        self.loop.call_soon_threadsafe(shutdown)
+        self.executor.shutdown(wait=False)
+
+    def submit(self, func, *args, priority=(0,)):
+        """从任意线程（如 GUI 线程）提交一个占用发送名额的阻塞任务"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(
+            self.run_transfer('send', func, *args, priority=priority), self.loop
+        )
+
+    def serve(self, server, handler):
+        """在事件循环中接受 server 上的连接，每个连接交给协程 handler(client, addr) 处理"""
+        self.start()
+        self.loop.call_soon_threadsafe(self.spawn, self.accept_loop(server, handler))
+
+    async def run_transfer(self, direction, func, *args, priority=(0,)):
+        slots = self.slots[direction]
+        await slots.acquire(priority)
+        try:
+            return await self.loop.run_in_executor(self.executor, func, *args)
+        finally:
+            slots.release()
+
+    async def run_stream(self, func, *args):
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def accept_loop(self, server, handler):
+        server.setblocking(False)
+        while True:
+            try:
+                client, addr = await self.loop.sock_accept(server)
+            except OSError as e:
+                print(f"Error accepting connection: {e}")
+                break
+            self.spawn(handler(client, addr))
+
+    def spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Error in transfer task: {task.exception()}")
@@ -3,50 +3,204 @@ import socket
 import json
 import time
 import os
-from datetime import datetime
+import random
+import select
+import struct
+import threading
+from collections import deque
+from network.file_server import SUPPORTED_FEATURES
+from network.batch import build_manifest
+from network import wire
+from network.peers import PeerTable
+from network.relay import RELAY_PORT
+from network.reliable import ReliableMessenger
+
+BASE_INTERVAL = 10  # 在线广播的基础间隔（秒）
+MAX_INTERVAL = 120
+TARGET_RATE = 20  # 希望整个网段每秒收到的在线广播总数，据此随在线人数拉长间隔
+STABLE_FACTOR = 1.5  # 在线列表一个间隔内没有变化时，间隔按此倍数增长
+LARGE_ROSTER = 50  # 在线人数达到该值才因列表稳定而拉长间隔，人少时及时发现异常离线更重要
+JITTER = 0.25  # 间隔随机浮动 ±25%，避免各客户端同时广播
+REPLY_SPREAD = 1.0  # 向新上线的用户单播回应前的随机延迟上限，避免回应同时到达
+STARTUP_GRACE = 5  # 刚启动时是别人回应我们，这段时间内不回应
+OFFLINE_TIMEOUT = 30  # 至少这么久没有收到在线广播才认为离线
+INTERFACE_REFRESH = 60  # 重新枚举网络接口的间隔
+REPLY_RATE = 100  # 回应在线查询时，整个网段每秒的回应数，据此随在线人数拉长随机延迟
+QUERY_GRACE = 2  # 最晚的回应发出后再等这么久，仍未确认的用户视为离线
+ROSTER_FILE = 'roster.json'
+ROSTER_SAVE_INTERVAL = 60  # 在线列表有变化时最多每分钟保存一次
+MESSAGE_FEATURES = ['reliable']  # 在线广播中声明的消息扩展
+MAX_PLAIN_MESSAGE = 60000  # 不支持可靠消息的对端只能收单个数据报
+UDP_RECV_BUFFER = 4 * 1024 * 1024  # 在线广播集中到达时由内核缓冲，处理线程来不及取也不至于丢包
+RECV_BATCH = 64  # 每次醒来最多连续读取的数据报数
+CONTROL_QUEUE = 4096  # 聊天、分片、确认和文件请求的待处理上限
+PRESENCE_QUEUE = 2048  # 在线广播和查询的待处理上限；这类数据会周期性重发，满时先丢
+DROP_REPORT_INTERVAL = 10
+MULTICAST_TTL = 4  # 组播可以经过的路由器数，各网段之间需要开启组播路由
 
 class UDPListener(QThread):
+    """接收线程只负责把数据报成批读出放入队列，解析和处理在工作线程中进行
+
+    队列按类型分为两个并各自限长：在线广播和查询单独排队，满了直接丢弃新到的，
+    不会挤掉聊天消息和分片；工作线程优先处理控制消息队列。
+    """
+
     def __init__(self, callback):
         super().__init__()
         self.callback = callback
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        try:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RECV_BUFFER)
+        except OSError as e:
+            print(f"Error setting UDP receive buffer: {e}")
         self.socket.bind(('0.0.0.0', 15000))
+        self.socket.setblocking(False)
         self.running = True
+        self.control = deque()
+        self.presence = deque()
+        self.cond = threading.Condition()
+        self.counters = dict.fromkeys(('received', 'batches', 'dropped_control', 'dropped_presence',
+                                       'decode_errors', 'handler_errors'), 0)
+        self.max_batch = 0
+        self.max_queued = 0
+        self.drop_reported = 0.0
+        self.worker = threading.Thread(target=self.work, name='udp-worker', daemon=True)
+        self.worker.start()
+
+    def join_group(self, group):
+        # 在默认接口上加入组播组，收到的组播和广播走同一个套接字
+        membership = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton('0.0.0.0'))
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
 
     def run(self):
         while self.running:
             try:
-                data, addr = self.socket.recvfrom(65535)
-                self.callback(data, addr)
-            except Exception as e:
-                print(f"Error in UDP listener: {e}")
-                time.sleep(0.1)
+                readable, _, _ = select.select([self.socket], [], [], 0.5)
+            except (OSError, ValueError):
+                break  # 套接字已关闭
+            if not readable:
+                continue
+            batch = []
+            while len(batch) < RECV_BATCH:
+                try:
+                    batch.append(self.socket.recvfrom(65535))
+                except BlockingIOError:
+                    break
+                except OSError as e:
+                    # Windows 上对方端口不可达会在下一次接收时报错，跳过即可
+                    if not self.running:
+                        return
+                    print(f"Error in UDP listener: {e}")
+                    break
+            if batch:
+                self.enqueue(batch)
+
+    def enqueue(self, batch):
+        with self.cond:
+            self.counters['received'] += len(batch)
+            self.counters['batches'] += 1
+            self.max_batch = max(self.max_batch, len(batch))
+            for item in batch:
+                if wire.is_presence(item[0]):
+                    queue, limit, counter = self.presence, PRESENCE_QUEUE, 'dropped_presence'
+                else:
+                    queue, limit, counter = self.control, CONTROL_QUEUE, 'dropped_control'
+                if len(queue) >= limit:
+                    self.counters[counter] += 1
+                else:
+                    queue.append(item)
+            self.max_queued = max(self.max_queued, len(self.control) + len(self.presence))
+            self.cond.notify()
+            dropped = self.counters['dropped_control'] + self.counters['dropped_presence']
+            if dropped and time.monotonic() - self.drop_reported >= DROP_REPORT_INTERVAL:
+                self.drop_reported = time.monotonic()
+                print(f"UDP ingest dropping packets: {self.counters}")  # 调试信息
+
+    def work(self):
+        while True:
+            with self.cond:
+                while self.running and not self.control and not self.presence:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                batch = []
+                for queue in (self.control, self.presence):
+                    while queue and len(batch) < RECV_BATCH:
+                        batch.append(queue.popleft())
+            for data, addr in batch:
+                try:
+                    self.callback(data, addr)
+                except Exception as e:
+                    self.count('handler_errors')
+                    print(f"Error handling UDP packet from {addr}: {e}")
+
+    def count(self, name):
+        with self.cond:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self.cond:
+            return dict(self.counters, queued=len(self.control) + len(self.presence),
+                        max_batch=self.max_batch, max_queued=self.max_queued)
 
     def stop(self):
         self.running = False
         self.socket.close()
+        with self.cond:
+            self.cond.notify_all()
 
 class UDPClient(QObject):
     message_received = Signal(str, str)  # 发送者, 消息
+    message_status = Signal(str, str, str, int, int)  # IP, 消息 ID, 状态, 已确认分片数, 分片总数
+    group_message_received = Signal(str, str, str)  # 发送者, 群组名, 消息
     user_online = Signal(str, str)  # IP, 用户名
     user_offline = Signal(str)  # IP
+    user_restored = Signal(str, str)  # IP, 用户名；上次保存的在线列表，尚未确认在线
     file_request = Signal(str, str, int, str)  # sender_ip, filename, size, sender_name
+    batch_request = Signal(str, str, int, int, str)  # sender_ip, 目录名, 总大小, 文件数, sender_name
     file_transfer_request = Signal(str, str)  # filename, target_ip
+    batch_manifest = Signal(str, str, object)  # 目录, target_ip, (dirs, files)；对方接受后发送时直接使用
     file_accepted = Signal(str, str)  # filename, target_ip
     file_rejected = Signal(str, str)  # filename, sender_name
+    peer_features = Signal(str, list)  # IP, 对方支持的传输扩展
     file_transfer_complete = Signal(str, str, str)  # filename, operation, target_ip
     
     def __init__(self):
         super().__init__()
         self.broadcast_port = 15000
         self.username = "未命名用户"  # 默认用户名
-        self.online_users = {}  # {ip: (username, last_seen)}
+        self.online_users = PeerTable()  # 监听线程写入，心跳线程检查过期
         self.file_server_port = 15001
         self.app_identifier = "PyIPMSG"  # 添加应用标识
+        self.legacy_peers = set()  # 只能解析 JSON 消息的旧版对端
+        self.plain_peers = set()  # 在线广播中没有声明 reliable 的对端，消息只能单包发送
+        
+        # 跨网段发现：组播组和在线状态中继都是可选的，在设置的 discovery 项中配置
+        self.multicast_group = None
+        self.relay_addr = None  # (ip, port)
+        self.relay_version = None  # 上次从中继收到的列表版本
+        self.relay_peers = {}  # {ip: (username, interval)}，从中继得知的用户
+        
+        # 在线广播：间隔随在线人数和稳定程度变化，编码后的数据和广播地址都缓存起来
+        self.interval = BASE_INTERVAL
+        self.started = self.roster_changed = time.monotonic()
+        self.presence_packets = None  # (二进制, JSON)
+        self.pending_replies = {}  # {ip: 计划单播回应的时间}
         
-        # 获取本机所有IP地址
-        self.local_ips = self.get_local_ips()
+        # 在线查询：查询后收到的第一条在线状态确认该用户，超时仍未确认的恢复用户视为离线
+        self.unconfirmed = set()
+        self.query_started = None
+        self.query_deadline = None
+        self.query_replies = []  # 每个确认相对查询开始的秒数
+        self.roster_saved = time.monotonic()
+        self.roster_dirty = False
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        
+        # 获取本机所有IP地址和广播地址
+        self.local_ips, self.broadcast_addrs = self.get_interfaces()
+        self.interfaces_checked = time.monotonic()
         print(f"Local IPs: {self.local_ips}")  # 用于调试
         
         # 创建发送用的socket
@@ -54,12 +208,22 @@ class UDPClient(QObject):
         self.send_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         self.send_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         
+        # 可靠消息：分片、确认和重传，收齐后按普通消息投递
+        self.messenger = ReliableMessenger(self.send_packet, self.deliver_message, self.message_status.emit,
+                                           self.broadcast_packet)
+        
         # 创建并启动监听线程
         self.listener = UDPListener(self.handle_message)
         self.listener.start()
         
         # 加载保存的设置
         self.load_settings()
+        if self.multicast_group:
+            self.send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+            try:
+                self.listener.join_group(self.multicast_group)
+            except OSError as e:
+                print(f"Error joining multicast group {self.multicast_group}: {e}")
         
         # 定期发送在线状态
         self.start_heartbeat()
@@ -70,45 +234,112 @@ class UDPClient(QObject):
         
     def start_heartbeat(self):
         def heartbeat():
+            next_beat = time.monotonic()
             while True:
-                self.broadcast_presence()
+                now = time.monotonic()
+                if now - self.interfaces_checked >= INTERFACE_REFRESH:
+                    self.refresh_interfaces()
+                if now >= next_beat:
+                    self.broadcast_presence()
+                    self.set_interval(self.next_interval())
+                    next_beat = now + self.interval * random.uniform(1 - JITTER, 1 + JITTER)
                 self.check_online_users()
-                time.sleep(10)
+                self.send_pending_replies(now)
+                if self.query_deadline is not None and now >= self.query_deadline:
+                    self.finish_query()
+                if self.roster_dirty and now - self.roster_saved >= ROSTER_SAVE_INTERVAL:
+                    self.save_roster()
+                
+                # 在最近的过期时刻醒来，不再定期扫描在线列表
+                deadline = self.online_users.next_deadline()
+                with self.lock:
+                    due = min([next_beat] + list(self.pending_replies.values()))
+                if self.query_deadline is not None:
+                    due = min(due, self.query_deadline)
+                if deadline is not None:
+                    due = min(due, deadline)
+                self.wakeup.wait(max(0, due - time.monotonic()))
+                self.wakeup.clear()
         
         self.heartbeat_thread = QThread()
         self.heartbeat_thread.run = heartbeat
         self.heartbeat_thread.start()
         
-    def check_online_users(self):
-        current_time = datetime.now()
-        offline_users = []
-        for ip, (username, last_seen) in self.online_users.items():
-            if (current_time - last_seen).seconds > 30:
-                offline_users.append(ip)
+    def next_interval(self):
+        # 旧版客户端 30 秒没收到广播就认为离线，网段中有旧版客户端时保持基础间隔
+        if self.legacy_peers:
+            return BASE_INTERVAL
+        interval = min(MAX_INTERVAL, max(BASE_INTERVAL, len(self.online_users) / TARGET_RATE))
+        if (len(self.online_users) >= LARGE_ROSTER
+                and time.monotonic() - self.roster_changed >= self.interval):
+            interval = min(MAX_INTERVAL, max(interval, self.interval * STABLE_FACTOR))
+        return interval
+    
+    def set_interval(self, interval):
+        if interval != self.interval:
+            self.interval = interval
+            self.presence_packets = None  # 广播数据中带有间隔，需要重新编码
+    
+    def roster_change(self):
+        # 有人上线或离线时恢复较短的间隔
+        self.roster_changed = time.monotonic()
+        self.roster_dirty = True
         
+    def check_online_users(self):
+        offline_users = self.online_users.expire()
         for ip in offline_users:
-            del self.online_users[ip]
+            self.legacy_peers.discard(ip)  # 离线的旧版客户端不再需要 JSON 广播和基础间隔
             self.user_offline.emit(ip)
+        if offline_users:
+            self.roster_change()
+            print(f"Peers expired: {offline_users}, {self.online_users.stats()}")  # 调试信息
     
     def handle_message(self, data, addr):
         try:
-            msg = json.loads(data.decode())
+            # 自动识别二进制和 JSON 格式，其他应用的数据在解析前就被丢弃
+            msg, binary = wire.decode(data, self.app_identifier)
+            if msg is None:
+                # 二进制的魔数或 JSON 中的应用标识说明是本应用的数据，只是格式不对
+                if binary or (data.startswith(b'{') and self.app_identifier.encode() in data):
+                    self.listener.count('decode_errors')
+                return
             sender_ip = addr[0]
             
-            # 检查是否是来自同一应用的消息
-            if msg.get('app') != self.app_identifier:
+            # 中继可能和本机在同一台机器上，先于本机地址过滤处理
+            if msg['type'] == 'roster':
+                if addr == self.relay_addr:
+                    self.handle_roster(msg)
                 return
                 
             # 如果是本机的其他IP地址发来的消息，忽略它
             if sender_ip in self.local_ips:
                 return
+            
+            # 新版发出的 JSON 消息带有 wire 字段，没有的说明对方只能解析 JSON
+            if binary or msg.get('wire'):
+                self.legacy_peers.discard(sender_ip)
+            else:
+                self.legacy_peers.add(sender_ip)
                 
             if msg['type'] == 'message':
                 self.message_received.emit(sender_ip, msg['content'])
             
+            elif msg['type'] == 'chunk':
+                # 群发的广播分片带有接收方列表，不是发给本机的不处理
+                recipients = msg.get('recipients')
+                if not recipients or self.local_ips.intersection(recipients):
+                    self.messenger.handle_chunk(sender_ip, msg)
+            
+            elif msg['type'] == 'ack':
+                self.messenger.handle_ack(sender_ip, msg)
+            
             elif msg['type'] == 'presence':
-                self.online_users[sender_ip] = (msg['username'], datetime.now())
-                self.user_online.emit(sender_ip, msg['username'])
+                self.update_features(sender_ip, msg)
+                self.handle_presence(sender_ip, msg)
+            
+            elif msg['type'] == 'query':
+                self.update_features(sender_ip, msg)
+                self.handle_query(sender_ip, msg)
             
             elif msg['type'] == 'file_request':
                 self.file_request.emit(
@@ -118,53 +349,290 @@ class UDPClient(QObject):
                     msg.get('sender', '未知用户')
                 )
                 
+            elif msg['type'] == 'batch_request':
+                self.batch_request.emit(
+                    sender_ip,
+                    msg['filename'],
+                    int(msg['size']),
+                    int(msg['count']),
+                    msg.get('sender', '未知用户')
+                )
+                
             elif msg['type'] == 'file_response':
                 if msg['accepted']:
+                    # 先更新对方能力，再触发传输
+                    self.peer_features.emit(sender_ip, msg.get('features', []))
                     self.file_accepted.emit(msg['filename'], sender_ip)
                 else:
                     # 获取拒绝者的用户名
-                    sender_name = self.online_users.get(sender_ip, ('未知用户', None))[0]
+                    sender_name = self.online_users.username(sender_ip, '未知用户')
                     self.file_rejected.emit(msg['filename'], sender_name)
             
         except Exception as e:
+            self.listener.count('handler_errors')
             print(f"Error handling message: {e}")
     
+    def ingest_stats(self):
+        """UDP 接收计数：收到、各队列丢弃、格式错误和处理出错的数据报数"""
+        return self.listener.stats()
+    
     def send_message(self, message, target_ip):
+        payload = message.encode()
+        if target_ip not in self.legacy_peers and target_ip not in self.plain_peers:
+            try:
+                self.messenger.send_message(target_ip, payload)
+            except ValueError as e:
+                self.message_status.emit(target_ip, '', 'failed', 0, 0)
+                print(f"Error sending message: {e}")
+            return
+        
+        # 旧版对端：单个数据报，没有送达确认
         data = {
             'app': self.app_identifier,
             'type': 'message',
             'content': message
         }
-        self.send_socket.sendto(json.dumps(data).encode(), (target_ip, self.broadcast_port))
+        if len(payload) > MAX_PLAIN_MESSAGE:
+            self.message_status.emit(target_ip, '', 'failed', 0, 1)
+            return
+        self.send_packet(data, target_ip)
+        self.message_status.emit(target_ip, '', 'sent', 0, 1)
+    
+    def send_group_message(self, message, group, target_ips):
+        """群发：支持可靠消息的接收方共用一次广播，其余逐个单包发送"""
+        reliable = [ip for ip in target_ips if ip not in self.legacy_peers and ip not in self.plain_peers]
+        for ip in target_ips:
+            if ip not in reliable:
+                self.send_message(message, ip)
+        if reliable:
+            try:
+                self.messenger.send_group(reliable, message.encode(), group)
+            except ValueError as e:
+                for ip in reliable:
+                    self.message_status.emit(ip, '', 'failed', 0, 0)
+                print(f"Error sending group message: {e}")
+    
+    def broadcast_packet(self, data):
+        # 配置了组播组时只发组播，跨网段的接收方收不到广播，靠单播重传补上
+        addrs = [self.multicast_group] if self.multicast_group else self.broadcast_addrs
+        packet = self.encode_packet(data)
+        for addr in addrs:
+            try:
+                self.send_socket.sendto(packet, (addr, self.broadcast_port))
+            except OSError as e:
+                print(f"Error broadcasting to {addr}: {e}")
+    
+    def deliver_message(self, sender_ip, payload, group=''):
+        content = payload.decode('utf-8', errors='replace')
+        if group:
+            self.group_message_received.emit(sender_ip, group, content)
+        else:
+            self.message_received.emit(sender_ip, content)
     
-    def broadcast_presence(self):
+    def update_features(self, sender_ip, msg):
+        # 二进制格式但没有声明 reliable 的是早期版本，收不了分片
+        if 'reliable' in msg.get('features', []) or sender_ip in self.legacy_peers:
+            self.plain_peers.discard(sender_ip)
+        else:
+            self.plain_peers.add(sender_ip)
+    
+    def encode_packet(self, data, legacy=False):
+        if legacy:
+            return json.dumps(dict(data, wire=wire.VERSION)).encode()
+        return wire.encode(data)
+    
+    def send_packet(self, data, target_ip):
+        # 旧版对端发 JSON，其余发二进制
+        packet = self.encode_packet(data, target_ip in self.legacy_peers)
+        self.send_socket.sendto(packet, (target_ip, self.broadcast_port))
+    
+    def handle_presence(self, sender_ip, msg, reply=True):
+        if msg.get('status') == 'offline':
+            # 对方正常退出时会立即通知
+            self.legacy_peers.discard(sender_ip)
+            if self.online_users.remove(sender_ip):
+                self.roster_change()
+                self.user_offline.emit(sender_ip)
+            return
+        
+        # 对方的广播间隔可能较长，超时时间按其间隔放宽
+        interval = msg.get('interval') or BASE_INTERVAL
+        timeout = max(OFFLINE_TIMEOUT, interval * 3)
+        new, renamed = self.online_users.touch(sender_ip, msg['username'], timeout)
+        if new:
+            self.roster_change()
+        if (new and reply and self.query_deadline is None
+                and time.monotonic() - self.started > STARTUP_GRACE):
+            # 新上线的用户不必等到我们的下一次广播
+            self.schedule_reply(sender_ip, REPLY_SPREAD)
+        if new:
+            self.wakeup.set()  # 心跳线程按新的最近过期时刻重新计算等待时间
+        confirmed = sender_ip in self.unconfirmed
+        if confirmed:
+            self.unconfirmed.discard(sender_ip)
+            if self.query_started is not None:
+                self.query_replies.append(time.monotonic() - self.query_started)
+        if new or renamed or confirmed:
+            self.user_online.emit(sender_ip, msg['username'])
+    
+    def reply_spread(self):
+        # 人越多回应越分散，避免查询方同时收到上千个回应
+        return max(REPLY_SPREAD, len(self.online_users) / REPLY_RATE)
+    
+    def schedule_reply(self, ip, spread):
+        with self.lock:
+            self.pending_replies[ip] = time.monotonic() + random.uniform(0, spread)
+        self.wakeup.set()
+    
+    def handle_query(self, sender_ip, msg):
+        # 查询中带有对方的在线状态，随后按随机延迟单播回应
+        self.handle_presence(sender_ip, dict(msg, status='online'), reply=False)
+        self.schedule_reply(sender_ip, self.reply_spread())
+    
+    def query_roster(self):
+        """广播在线查询，各用户在随机延迟后单播回应；刷新按钮和启动时调用"""
+        self.unconfirmed.update(ip for ip, _ in self.online_users.snapshot())
+        self.query_started = time.monotonic()
+        self.query_deadline = self.query_started + self.reply_spread() + QUERY_GRACE
+        self.query_replies = []
         data = {
             'app': self.app_identifier,
+            'type': 'query',
+            'username': self.username,
+            'interval': int(self.interval),
+            'features': MESSAGE_FEATURES
+        }
+        packets = [self.encode_packet(data)]
+        if self.legacy_peers:
+            # 旧版客户端不认识查询，发送在线广播让它们至少能看到我们
+            packets.append(self.get_presence_packets()[1])
+        addrs = self.broadcast_addrs + ([self.multicast_group] if self.multicast_group else [])
+        for addr in addrs:
+            for packet in packets:
+                try:
+                    self.send_socket.sendto(packet, (addr, self.broadcast_port))
+                except OSError as e:
+                    print(f"Error sending roster query to {addr}: {e}")
+        if self.relay_addr:
+            self.relay_version = None  # 要求中继回应完整列表
+            self.send_relay()
+        self.wakeup.set()
+    
+    def finish_query(self):
+        # 上次保存的用户中没有回应也不在在线列表里的，从界面上移除
+        self.query_deadline = None
+        for ip in list(self.unconfirmed):
+            if ip not in self.online_users:
+                self.unconfirmed.discard(ip)
+                self.user_offline.emit(ip)
+        replies = self.query_replies
+        print(f"Roster query: {len(replies)} confirmed, {len(self.online_users)} online, "
+              f"full roster after {max(replies, default=0):.2f}s")  # 调试信息
+    
+    def restore_roster(self):
+        """显示上次保存的在线列表，标记为未确认，然后查询谁在线"""
+        try:
+            with open(ROSTER_FILE, 'r', encoding='utf-8') as f:
+                roster = json.load(f)
+        except Exception:
+            roster = {}
+        for ip, username in roster.items():
+            if ip not in self.local_ips and ip not in self.online_users:
+                self.unconfirmed.add(ip)
+                self.user_restored.emit(ip, username)
+        self.query_roster()
+    
+    def save_roster(self):
+        self.roster_saved = time.monotonic()
+        self.roster_dirty = False
+        try:
+            with open(ROSTER_FILE, 'w', encoding='utf-8') as f:
+                json.dump(dict(self.online_users.snapshot()), f, ensure_ascii=False)
+        except Exception as e:
+            print(f"Error saving roster: {e}")
+    
+    def handle_roster(self, msg):
+        if not msg['peers'] and msg['version'] == self.relay_version:
+            # 列表没有变化，中继只回应确认，刷新从中继得知的用户
+            entries = [(ip, username, interval) for ip, (username, interval) in self.relay_peers.items()]
+        else:
+            # 完整列表可能分成多页，每页单独处理，没有出现在新列表中的用户按超时移除
+            if msg['version'] != self.relay_version:
+                self.relay_version = msg['version']
+                self.relay_peers = {}
+            entries = [entry for entry in msg['peers'] if entry[0] not in self.local_ips]
+            for ip, username, interval in entries:
+                self.relay_peers[ip] = (username, interval)
+        for ip, username, interval in entries:
+            # 这些用户收不到我们的广播，也不会在我们的下一次心跳前刷新，超时按两边较长的间隔计算
+            presence = {'status': 'online', 'username': username,
+                        'interval': max(interval, self.interval)}
+            self.handle_presence(ip, presence, reply=False)
+    
+    def send_relay(self, status='online'):
+        # 从监听套接字发出，中继的回应直接回到监听线程
+        data = {
             'type': 'presence',
-            'status': 'online',
-            'username': self.username
+            'status': status,
+            'username': self.username,
+            'interval': int(self.interval),
+            'roster_version': self.relay_version
         }
         try:
-            # 获取所有网络接口的广播地址
-            import netifaces
-            for interface in netifaces.interfaces():
-                addrs = netifaces.ifaddresses(interface)
-                if netifaces.AF_INET in addrs:
-                    for addr in addrs[netifaces.AF_INET]:
-                        if 'broadcast' in addr:
-                            broadcast_addr = addr['broadcast']
-                            self.send_socket.sendto(
-                                json.dumps(data).encode(),
-                                (broadcast_addr, self.broadcast_port)
-                            )
-        except:
-            # 如果获取网络接口失败，使用默认广播地址
-            self.send_socket.sendto(
-                json.dumps(data).encode(),
-                ('255.255.255.255', self.broadcast_port)
-            )
+            self.listener.socket.sendto(wire.encode(data), self.relay_addr)
+        except OSError as e:
+            print(f"Error sending presence to relay {self.relay_addr}: {e}")
+    
+    def send_pending_replies(self, now):
+        with self.lock:
+            due = [ip for ip, at in self.pending_replies.items() if at <= now]
+            for ip in due:
+                del self.pending_replies[ip]
+        for ip in due:
+            packet = self.get_presence_packets()[1 if ip in self.legacy_peers else 0]
+            self.send_socket.sendto(packet, (ip, self.broadcast_port))
+    
+    def get_presence_packets(self, status='online'):
+        packets = self.presence_packets if status == 'online' else None
+        if packets is None:
+            data = {
+                'app': self.app_identifier,
+                'type': 'presence',
+                'status': status,
+                'username': self.username,
+                'interval': int(self.interval),
+                'features': MESSAGE_FEATURES
+            }
+            packets = (self.encode_packet(data), self.encode_packet(data, legacy=True))
+            if status == 'online':
+                self.presence_packets = packets
+        return packets
+    
+    def broadcast_presence(self, status='online'):
+        packets = self.get_presence_packets(status)
+        # 网段内还有旧版客户端时同时广播 JSON 格式
+        if not self.legacy_peers:
+            packets = packets[:1]
+        addrs = self.broadcast_addrs + ([self.multicast_group] if self.multicast_group else [])
+        for broadcast_addr in addrs:
+            for packet in packets:
+                try:
+                    self.send_socket.sendto(packet, (broadcast_addr, self.broadcast_port))
+                except OSError as e:
+                    print(f"Error broadcasting presence to {broadcast_addr}: {e}")
+                    self.interfaces_checked = 0  # 接口可能已变化，下次心跳时重新枚举
+        if self.relay_addr:
+            self.send_relay(status)
+    
+    def announce_offline(self):
+        # 退出前通知其他用户，对方无需等待超时
+        self.broadcast_presence('offline')
+        self.save_roster()
     
     def send_file_request(self, filename, target_ip):
+        if os.path.isdir(filename):
+            self.send_batch_request(filename, target_ip)
+            return
         file_size = os.path.getsize(filename)
         data = {
             'app': self.app_identifier,
@@ -175,7 +643,32 @@ class UDPClient(QObject):
             'sender': self.username
         }
         # 先发送请求，不要立即触发传输
-        self.send_socket.sendto(json.dumps(data).encode(), (target_ip, self.broadcast_port))
+        self.send_packet(data, target_ip)
+
+    def send_batch_request(self, root, target_ip):
+        # 遍历大目录很慢，放在后台线程中进行
+        threading.Thread(target=self.request_batch, args=(root, target_ip),
+                         name='batch-manifest', daemon=True).start()
+
+    def request_batch(self, root, target_ip):
+        # 整个目录只需对方确认一次，完整的文件清单在传输连接上发送
+        try:
+            manifest = build_manifest(root)
+        except OSError as e:
+            print(f"Error reading folder {root}: {e}")
+            return
+        _, files = manifest
+        self.batch_manifest.emit(root, target_ip, manifest)  # 先于请求发出，对方接受时清单已就绪
+        data = {
+            'app': self.app_identifier,
+            'type': 'batch_request',
+            'filename': os.path.basename(os.path.normpath(root)),
+            'size': sum(entry['size'] for entry in files),
+            'count': len(files),
+            'port': self.file_server_port,
+            'sender': self.username
+        }
+        self.send_packet(data, target_ip)
 
     def send_file_response(self, filename, target_ip, accepted):
         data = {
@@ -184,30 +677,56 @@ class UDPClient(QObject):
             'filename': filename,
             'accepted': accepted
         }
-        self.send_socket.sendto(json.dumps(data).encode(), (target_ip, self.broadcast_port))
+        if accepted:
+            data['features'] = SUPPORTED_FEATURES
+        self.send_packet(data, target_ip)
 
     def load_settings(self):
         try:
             with open('settings.json', 'r', encoding='utf-8') as f:
                 settings = json.load(f)
                 self.username = settings.get('username', self.username)
+                # {"discovery": {"multicast_group": "239.255.80.77", "relay": "10.0.0.5:15002"}}
+                discovery = settings.get('discovery', {})
+                self.multicast_group = discovery.get('multicast_group') or None
+                if discovery.get('relay'):
+                    host, _, port = discovery['relay'].partition(':')
+                    self.relay_addr = (socket.gethostbyname(host), int(port or RELAY_PORT))
         except:
             pass
             
     def save_settings(self):
         try:
+            # 保留界面和传输模块的设置项
+            try:
+                with open('settings.json', 'r', encoding='utf-8') as f:
+                    settings = json.load(f)
+            except:
+                settings = {}
+            settings['username'] = self.username
             with open('settings.json', 'w', encoding='utf-8') as f:
-                json.dump({'username': self.username}, f, ensure_ascii=False)
+                json.dump(settings, f, ensure_ascii=False)
         except:
             pass
 
     def set_username(self, username):
         self.username = username
+        self.presence_packets = None
         self.save_settings()  # 保存设置
         self.broadcast_presence()  # 立即广播新用户名 
 
-    def get_local_ips(self):
+    def refresh_interfaces(self):
+        local_ips, broadcast_addrs = self.get_interfaces()
+        self.interfaces_checked = time.monotonic()
+        if local_ips != self.local_ips or broadcast_addrs != self.broadcast_addrs:
+            print(f"Network interfaces changed: {local_ips}")  # 调试信息
+            self.local_ips, self.broadcast_addrs = local_ips, broadcast_addrs
+            self.broadcast_presence()  # 在新的网络上立即宣告在线
+
+    def get_interfaces(self):
+        """返回本机 IP 集合和各接口的广播地址列表"""
         local_ips = set()
+        broadcast_addrs = []
         try:
             import netifaces
             for interface in netifaces.interfaces():
@@ -216,8 +735,11 @@ class UDPClient(QObject):
                     for addr in addrs[netifaces.AF_INET]:
                         if 'addr' in addr and addr['addr'] != '127.0.0.1':
                             local_ips.add(addr['addr'])
+                        if 'broadcast' in addr and addr['broadcast'] not in broadcast_addrs:
+                            broadcast_addrs.append(addr['broadcast'])
         except:
             import socket
             hostname = socket.gethostname()
             local_ips.add(socket.gethostbyname(hostname))
-        return local_ips 
\ No newline at end of file
+        # 获取网络接口失败时使用默认广播地址
+        return local_ips, broadcast_addrs or ['255.255.255.255']
@@ -0,0 +1,138 @@
+import json
+import socket
+import struct
+
+# UDP 控制消息的二进制编码：
+#   MAGIC(3) + 版本(1) + 类型(1) + 若干字段，每个字段为 2 字节长度 + 内容
+# 字段按各类型的固定顺序排列，新版本只在末尾追加字段：旧的接收方忽略多出的字段，
+# 新的接收方遇到缺少的末尾字段时不设置该项。
+MAGIC = b'PIM'
+VERSION = 1
+HEADER = struct.Struct('!3sBB')  # magic, version, type
+FIELD_LENGTH = struct.Struct('!H')
+INT = struct.Struct('!Q')
+ENTRY = struct.Struct('!4sHH')  # IP, 广播间隔, 用户名长度
+
+STR, INT_FIELD, BOOL, LIST, ENTRIES, BYTES, ADDRESSES = range(7)
+
+MESSAGE_TYPES = {
+    'message': (1, [('content', STR)]),
+    'presence': (2, [('status', STR), ('username', STR), ('interval', INT_FIELD),
+                     ('roster_version', INT_FIELD), ('features', LIST)]),
+    'file_request': (3, [('filename', STR), ('size', INT_FIELD), ('port', INT_FIELD),
+                         ('sender', STR)]),
+    'file_response': (4, [('filename', STR), ('accepted', BOOL), ('features', LIST)]),
+    'batch_request': (5, [('filename', STR), ('size', INT_FIELD), ('count', INT_FIELD),
+                          ('port', INT_FIELD), ('sender', STR)]),
+    'roster': (6, [('version', INT_FIELD), ('peers', ENTRIES)]),
+    'query': (7, [('username', STR), ('interval', INT_FIELD), ('features', LIST)]),
+    'chunk': (8, [('id', INT_FIELD), ('index', INT_FIELD), ('count', INT_FIELD), ('data', BYTES),
+                  ('group', STR), ('recipients', ADDRESSES)]),
+    'ack': (9, [('id', INT_FIELD), ('received', INT_FIELD), ('bitmap', BYTES)]),
+}
+TYPE_NAMES = {code: (name, fields) for name, (code, fields) in MESSAGE_TYPES.items()}
+
+def encode_field(kind, value):
+    if kind == STR:
+        return (value or '').encode()
+    if kind == INT_FIELD:
+        return INT.pack(int(value or 0))
+    if kind == BOOL:
+        return b'\x01' if value else b'\x00'
+    if kind == BYTES:
+        return bytes(value or b'')
+    if kind == ADDRESSES:
+        return b''.join(socket.inet_aton(ip) for ip in value or [])
+    if kind == ENTRIES:
+        parts = []
+        for ip, username, interval in value or []:
+            name = username.encode()
+            parts.append(ENTRY.pack(socket.inet_aton(ip), min(int(interval), 0xFFFF), len(name)))
+            parts.append(name)
+        return b''.join(parts)
+    return ','.join(value or []).encode()
+
+def decode_field(kind, data):
+    if kind == STR:
+        return data.decode()
+    if kind == INT_FIELD:
+        return INT.unpack(data)[0]
+    if kind == BOOL:
+        return data != b'\x00'
+    if kind == BYTES:
+        return bytes(data)
+    if kind == ADDRESSES:
+        return [socket.inet_ntoa(data[i:i + 4]) for i in range(0, len(data) - 3, 4)]
+    if kind == ENTRIES:
+        entries = []
+        offset = 0
+        while offset < len(data):
+            ip, interval, length = ENTRY.unpack_from(data, offset)
+            offset += ENTRY.size
+            entries.append((socket.inet_ntoa(ip), data[offset:offset + length].decode(), interval))
+            offset += length
+        return entries
+    return data.decode().split(',') if data else []
+
+def encode(message):
+    """把与 JSON 格式相同的消息字典编码为二进制，不认识的类型返回 None"""
+    entry = MESSAGE_TYPES.get(message.get('type'))
+    if entry is None:
+        return None
+    code, fields = entry
+    parts = [HEADER.pack(MAGIC, VERSION, code)]
+    for name, kind in fields:
+        value = encode_field(kind, message.get(name))
+        parts.append(FIELD_LENGTH.pack(len(value)))
+        parts.append(value)
+    return b''.join(parts)
+
+BULK_TYPES = (MESSAGE_TYPES['presence'][0], MESSAGE_TYPES['query'][0])
+
+def is_presence(data):
+    """不解析内容判断是否为在线广播或查询，接收队列满时这类数据先被丢弃"""
+    if data[:len(MAGIC)] == MAGIC:
+        return len(data) >= HEADER.size and data[HEADER.size - 1] in BULK_TYPES
+    return b'"presence"' in data
+
+def decode(data, app_identifier):
+    """解析收到的 UDP 数据，返回 (消息字典, 是否为二进制格式)，不是本应用的数据返回 (None, False)
+
+    二进制数据只看前几个字节就能判断；JSON 数据先检查应用标识是否出现再解析。
+    """
+    if data[:len(MAGIC)] == MAGIC:
+        return decode_binary(data), True
+    if not data.startswith(b'{') or app_identifier.encode() not in data:
+        return None, False
+    try:
+        message = json.loads(data.decode())
+    except ValueError:
+        return None, False
+    if not isinstance(message, dict) or message.get('app') != app_identifier:
+        return None, False
+    return message, False
+
+def decode_binary(data):
+    if len(data) < HEADER.size:
+        return None
+    _, version, code = HEADER.unpack_from(data)
+    entry = TYPE_NAMES.get(code)
+    if entry is None or version < 1:
+        return None
+    name, fields = entry
+    message = {'type': name}
+    offset = HEADER.size
+    try:
+        for field, kind in fields:
+            if offset == len(data):
+                break  # 旧版本发出的消息没有后来追加的字段
+            length, = FIELD_LENGTH.unpack_from(data, offset)
+            offset += FIELD_LENGTH.size
+            value = data[offset:offset + length]
+            if len(value) < length:
+                return None
+            offset += length
+            message[field] = decode_field(kind, value)
+    except (struct.error, UnicodeDecodeError):
+        return None
+    return message
@@ -0,0 +1,66 @@
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+
+from network import reliable, wire
+from network.reliable import ReliableMessenger
+
+SENDER = '10.0.0.1'
+
+class LoopbackNetwork:
+    """在进程内转发编码后的消息，不在 peers 中的地址相当于不回应的接收方"""
+
+    def __init__(self):
+        self.peers = {}
+
+    def deliver(self, name, data, ip):
+        target = self.peers.get(ip)
+        if target is None:
+            return
+        msg = wire.decode_binary(wire.encode(data))
+        handler = target.handle_chunk if msg['type'] == 'chunk' else target.handle_ack
+        threading.Thread(target=handler, args=(name, msg), daemon=True).start()
+
+    def sender(self, name):
+        return lambda data, ip: self.deliver(name, data, ip)
+
+    def broadcast(self, name):
+        def send(data):
+            for ip in data.get('recipients') or []:
+                self.deliver(name, data, ip)
+        return send
+
+class GroupSendTest(unittest.TestCase):
+    def wait_for(self, condition, timeout):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_silent_member_does_not_block_group(self):
+        network = LoopbackNetwork()
+        states = {}
+        received = {}
+        sender = ReliableMessenger(network.sender(SENDER), None,
+                                   lambda ip, message_id, state, done, total: states.__setitem__(ip, state),
+                                   network.broadcast(SENDER))
+        network.peers[SENDER] = sender
+        live = [f'10.0.0.{i}' for i in range(2, 6)]
+        for ip in live:
+            network.peers[ip] = ReliableMessenger(
+                network.sender(ip),
+                lambda source, payload, group, ip=ip: received.setdefault(ip, []).append((group, payload)),
+                lambda *args: None)
+        payload = os.urandom(300000)  # 分片数远多于 WINDOW
+
+        with mock.patch.object(reliable, 'GIVE_UP', 2):
+            sender.send_group(live + ['10.0.0.99'], payload, 'ops')
+            self.assertTrue(self.wait_for(lambda: all(states.get(ip) == 'delivered' for ip in live), 5))
+            for ip in live:
+                self.assertEqual(received[ip], [('ops', payload)])
+            self.assertTrue(self.wait_for(lambda: states.get('10.0.0.99') == 'failed', 5))
+
+if __name__ == '__main__':
+    unittest.main()
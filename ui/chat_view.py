@@ -0,0 +1,164 @@
+from PySide6.QtCore import Qt, QAbstractListModel, QModelIndex
+from PySide6.QtGui import QGuiApplication, QKeySequence
+from PySide6.QtWidgets import QListView, QAbstractItemView
+from .history import PAGE_SIZE
+
+MAX_ROWS = 1000  # 模型中最多保留的消息数，滚动加载时超出的部分从另一端移除
+
+class ChatModel(QAbstractListModel):
+    """当前对话中已加载的一段聊天记录
+
+    打开对话时只读取最近一页，向上滚动到顶时读取更早的一页；加载的行数超过 MAX_ROWS 时从另一端移除，
+    再滚回去时重新读取，所以内存占用与记录总量无关。
+    """
+
+    def __init__(self, history, parent=None):
+        super().__init__(parent)
+        self.history = history
+        self.peer = None
+        self.rows = []  # [(id, 文字)]
+        self.has_older = False
+        self.has_newer = False  # 末尾之后还有未加载的消息，新消息此时不加入模型
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid():
+            return self.rows[index.row()][1]
+        return None
+
+    def load_latest(self, peer):
+        self.beginResetModel()
+        self.peer = peer
+        self.rows = self.history.page(peer)
+        self.has_older = len(self.rows) == PAGE_SIZE
+        self.has_newer = False
+        self.endResetModel()
+
+    def load_around(self, peer, message_id):
+        """以指定消息为中心加载前后各半页，返回它所在的行"""
+        self.beginResetModel()
+        self.peer = peer
+        half = PAGE_SIZE // 2
+        older = self.history.page(peer, message_id + 1, half)
+        newer = self.history.page_after(peer, message_id, half)
+        self.rows = older + newer
+        self.has_older = len(older) == half
+        self.has_newer = len(newer) == half
+        self.endResetModel()
+        return max(0, len(older) - 1)
+
+    def clear(self):
+        self.beginResetModel()
+        self.peer = None
+        self.rows = []
+        self.has_older = self.has_newer = False
+        self.endResetModel()
+
+    def fetch_older(self):
+        """在开头插入更早的一页，返回插入的行数"""
+        if not self.has_older or not self.rows:
+            return 0
+        older = self.history.page(self.peer, self.rows[0][0])
+        self.has_older = len(older) == PAGE_SIZE
+        if older:
+            self.beginInsertRows(QModelIndex(), 0, len(older) - 1)
+            self.rows[0:0] = older
+            self.endInsertRows()
+            self.trim_end()
+        return len(older)
+
+    def fetch_newer(self):
+        """在末尾追加较新的一页，返回从开头移除的行数"""
+        if not self.has_newer or not self.rows:
+            return 0
+        newer = self.history.page_after(self.peer, self.rows[-1][0])
+        self.has_newer = len(newer) == PAGE_SIZE
+        if newer:
+            self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(newer) - 1)
+            self.rows.extend(newer)
+            self.endInsertRows()
+        return self.trim_start()
+
+    def append(self, message_id, text):
+        if self.has_newer:
+            return
+        self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows))
+        self.rows.append((message_id, text))
+        self.endInsertRows()
+        self.trim_start()
+
+    def trim_start(self):
+        excess = len(self.rows) - MAX_ROWS
+        if excess <= 0:
+            return 0
+        self.beginRemoveRows(QModelIndex(), 0, excess - 1)
+        del self.rows[:excess]
+        self.endRemoveRows()
+        self.has_older = True
+        return excess
+
+    def trim_end(self):
+        excess = len(self.rows) - MAX_ROWS
+        if excess <= 0:
+            return
+        self.beginRemoveRows(QModelIndex(), MAX_ROWS, len(self.rows) - 1)
+        del self.rows[MAX_ROWS:]
+        self.endRemoveRows()
+        self.has_newer = True
+
+class ChatView(QListView):
+    """聊天记录视图：只绘制可见的行，滚动到两端时向模型请求更多记录"""
+
+    def __init__(self, model, parent=None):
+        super().__init__(parent)
+        self.setModel(model)
+        self.setWordWrap(True)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.follow = True  # 停在底部时新消息到达后继续滚动到底部
+        self.verticalScrollBar().valueChanged.connect(self.scrolled)
+        model.rowsAboutToBeInserted.connect(self.before_insert)
+        model.rowsInserted.connect(self.after_insert)
+        model.modelReset.connect(self.after_reset)
+
+    def scrolled(self, value):
+        bar = self.verticalScrollBar()
+        model = self.model()
+        if value == bar.minimum() and model.has_older:
+            # 加载后保持原来最上面的那一行仍在最上面
+            inserted = model.fetch_older()
+            if inserted:
+                self.scrollTo(model.index(inserted, 0), QAbstractItemView.PositionAtTop)
+        elif value == bar.maximum() and model.has_newer:
+            anchor = self.indexAt(self.viewport().rect().bottomLeft())
+            row = anchor.row() if anchor.isValid() else model.rowCount() - 1
+            removed = model.fetch_newer()
+            self.scrollTo(model.index(max(0, row - removed), 0), QAbstractItemView.PositionAtBottom)
+
+    def after_reset(self):
+        # 定位到某条消息时由调用者滚动，不滚到底部，否则会连续加载较新的页
+        if not self.model().has_newer:
+            self.scrollToBottom()
+
+    def before_insert(self, parent, first, last):
+        bar = self.verticalScrollBar()
+        self.follow = bar.value() >= bar.maximum()
+
+    def after_insert(self, parent, first, last):
+        if self.follow and last == self.model().rowCount() - 1:
+            self.scrollToBottom()
+
+    def show_row(self, row):
+        index = self.model().index(row, 0)
+        self.scrollTo(index, QAbstractItemView.PositionAtCenter)
+        self.setCurrentIndex(index)
+
+    def keyPressEvent(self, event):
+        if event.matches(QKeySequence.Copy):
+            rows = sorted(index.row() for index in self.selectedIndexes())
+            QGuiApplication.clipboard().setText('\n'.join(self.model().rows[row][1] for row in rows))
+            return
+        super().keyPressEvent(event)
@@ -0,0 +1,288 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+HISTORY_DB = 'chat_history.db'
+LEGACY_HISTORY = 'chat_history.json'
+SCHEMA_VERSION = 2
+FLUSH_INTERVAL = 0.5  # 新消息最多等这么久就写入数据库
+FLUSH_BATCH = 256  # 一个事务最多写入的消息数
+PAGE_SIZE = 200  # 按页读取时每页的消息数
+INDEX_BATCH = 200  # 后台为已有记录建立全文索引时每个事务处理的消息数，事务短才不会拖慢新消息的提交
+SEARCH_LIMIT = 100
+MIN_TERM = 3  # trigram 分词下短于 3 个字符的词无法使用索引，改为逐条匹配
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    peer TEXT NOT NULL,
+    ts REAL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_peer ON messages (peer, id);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+"""
+
+# 全文索引：以 messages 为外部内容的 FTS5 表，新消息由触发器在同一事务中加入索引；
+# trigram 分词按字符切分，中文不需要分词也能检索
+FTS_SCHEMA = (
+    """CREATE VIRTUAL TABLE messages_fts USING fts5(
+        text, content='messages', content_rowid='id', tokenize='{tokenize}'
+    )""",
+    """CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+    END""",
+)
+
+def fts_tokenizer():
+    """trigram 分词需要 SQLite 3.34 以上，更早的版本退回 unicode61"""
+    conn = sqlite3.connect(':memory:')
+    try:
+        conn.execute("CREATE VIRTUAL TABLE probe USING fts5(text, tokenize='trigram')")
+        return 'trigram'
+    except sqlite3.OperationalError:
+        return 'unicode61'
+    finally:
+        conn.close()
+
+class ChatHistory:
+    """聊天记录存储：SQLite WAL 模式，只追加
+
+    append 只把消息放入队列并返回预先分配的 id，写入线程按批次在一个事务中提交，界面线程不做磁盘 I/O；
+    WAL 模式下提交是原子的，程序崩溃最多丢失尚未提交的一批，不会损坏已有记录。
+    第一次打开时把旧版 chat_history.json 在同一个事务中导入，完成后改名保留。
+    全文索引随新消息同步更新；建立索引之前已有的记录由写入线程在空闲时分批补建，从最新的开始。
+    """
+
+    def __init__(self, path=HISTORY_DB, legacy_path=LEGACY_HISTORY):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.queue = queue.Queue()
+        self.ready = threading.Event()
+        self.error = None
+        self.lock = threading.Lock()
+        self.next_id = 1  # 只有本进程写入，id 在追加时分配，界面可以立即用它定位消息
+        self.committed_id = 0  # 写入线程已处理到的 id，追加的消息都已提交时读取不必等待写入线程
+        self.backfill_below = 0  # 小于该 id 的已有记录还没有全文索引
+        self.backfill_total = 0
+        self.closed = False  # close 之后写入线程已退出，读取直接返回空结果
+        self.writer = threading.Thread(target=self.run, name='history-writer', daemon=True)
+        self.writer.start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+        self.reader = self.connect()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')  # WAL 下只在检查点同步，崩溃不会损坏数据库
+        return conn
+
+    def run(self):
+        try:
+            conn = self.connect()
+            conn.executescript(SCHEMA)
+            self.migrate(conn)
+            self.next_id = (conn.execute('SELECT MAX(id) FROM messages').fetchone()[0] or 0) + 1
+            self.committed_id = self.next_id - 1
+            row = conn.execute("SELECT value FROM meta WHERE key = 'backfill_below'").fetchone()
+            self.backfill_below = row[0] if row else 0
+            self.backfill_total = self.backfill_below
+        except Exception as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.ready.set()
+        running = True
+        while running:
+            try:
+                # 还有记录没建索引时，队列空闲就去补建一批
+                item = self.queue.get(timeout=0 if self.backfill_below else None)
+            except queue.Empty:
+                self.backfill(conn)
+                continue
+            batch = []
+            waiters = []
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            # 攒够一批或等到 FLUSH_INTERVAL 再提交；flush 和 close 立即提交
+            while True:
+                if item is None:
+                    running = False
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= FLUSH_BATCH:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    with conn:
+                        conn.executemany('INSERT INTO messages (id, peer, ts, text) VALUES (?, ?, ?, ?)', batch)
+                except sqlite3.Error as e:
+                    print(f"Error saving chat history: {e}")
+                self.committed_id = batch[-1][0]
+            for waiter in waiters:
+                waiter.set()
+        conn.close()
+
+    def migrate(self, conn):
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        if version < 1:
+            self.import_legacy(conn)
+        if version < 2:
+            # 建表后新消息由触发器索引，之前的记录交给后台补建；与版本号在同一个事务中提交
+            conn.execute('BEGIN')
+            try:
+                for statement in FTS_SCHEMA:
+                    conn.execute(statement.format(tokenize=fts_tokenizer()))
+                last = conn.execute('SELECT MAX(id) FROM messages').fetchone()[0]
+                below = last + 1 if last else 0
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('backfill_below', ?)", (below,))
+                conn.execute('PRAGMA user_version = 2')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def import_legacy(self, conn):
+        history = {}
+        if os.path.exists(self.legacy_path):
+            # 旧版崩溃时可能留下写了一半的文件：改名保留，按没有旧记录继续
+            try:
+                with open(self.legacy_path, 'r', encoding='utf-8') as f:
+                    history = json.load(f)
+                if not isinstance(history, dict):
+                    raise ValueError("not a JSON object")
+            except (OSError, ValueError) as e:
+                print(f"Error reading {self.legacy_path}, moved aside: {e}")
+                history = {}
+                try:
+                    os.replace(self.legacy_path, self.legacy_path + '.corrupt')
+                except OSError:
+                    pass
+        # 旧记录没有时间，ts 留空，按 id 保持原来的顺序
+        with conn:
+            conn.executemany('INSERT INTO messages (peer, ts, text) VALUES (?, NULL, ?)',
+                             ((peer, text) for peer, messages in history.items() for text in messages))
+            conn.execute('PRAGMA user_version = 1')
+        if history:
+            os.replace(self.legacy_path, self.legacy_path + '.migrated')
+            print(f"Migrated chat history for {len(history)} peers")  # 调试信息
+
+    def backfill(self, conn):
+        """为一批尚未索引的已有记录建立索引，从较新的记录开始"""
+        try:
+            with conn:
+                rows = conn.execute('SELECT id, text FROM messages WHERE id < ? ORDER BY id DESC LIMIT ?',
+                                    (self.backfill_below, INDEX_BATCH)).fetchall()
+                conn.executemany('INSERT INTO messages_fts (rowid, text) VALUES (?, ?)', rows)
+                below = rows[-1][0] if rows else 0
+                conn.execute("UPDATE meta SET value = ? WHERE key = 'backfill_below'", (below,))
+        except sqlite3.Error as e:
+            print(f"Error indexing chat history: {e}")
+            below = 0
+        self.backfill_below = below
+        if not below:
+            print("Chat history index complete")  # 调试信息
+
+    def index_progress(self):
+        """已有记录建立全文索引的进度，0 到 1"""
+        if not self.backfill_total:
+            return 1.0
+        return 1 - self.backfill_below / self.backfill_total
+
+    def search(self, text, peer=None, since=None, until=None, limit=SEARCH_LIMIT):
+        """全文搜索，返回按相关度排序的 [(id, peer, ts, 文字)]
+
+        多个词之间为“且”；peer 限定对话，since/until 为时间戳范围（导入的旧记录没有时间，指定范围时不会匹配）。
+        """
+        terms = text.split()
+        if not terms or self.closed:
+            return []
+        self.flush()
+        filters = []
+        params = []
+        if peer is not None:
+            filters.append('m.peer = ?')
+            params.append(peer)
+        if since is not None:
+            filters.append('m.ts >= ?')
+            params.append(since)
+        if until is not None:
+            filters.append('m.ts < ?')
+            params.append(until)
+        if all(len(term) >= MIN_TERM for term in terms):
+            match = ' AND '.join('"' + term.replace('"', '""') + '"' for term in terms)
+            where = ' AND '.join(['messages_fts MATCH ?'] + filters)
+            sql = (f'SELECT m.id, m.peer, m.ts, m.text FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid '
+                   f'WHERE {where} ORDER BY bm25(messages_fts), m.id DESC LIMIT ?')
+            params = [match] + params
+        else:
+            # 短词走逐条匹配，按时间倒序
+            like = ["m.text LIKE ? ESCAPE '\\'" for _ in terms]
+            where = ' AND '.join(like + filters)
+            sql = f'SELECT m.id, m.peer, m.ts, m.text FROM messages m WHERE {where} ORDER BY m.id DESC LIMIT ?'
+            escaped = ['%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+                       for term in terms]
+            params = escaped + params
+        return self.reader.execute(sql, params + [limit]).fetchall()
+
+    def append(self, peer, text):
+        with self.lock:
+            message_id = self.next_id
+            self.next_id += 1
+            if self.closed:
+                print(f"Chat history closed, message for {peer} not saved")  # 调试信息
+            else:
+                self.queue.put((message_id, peer, time.time(), text))
+        return message_id
+
+    def flush(self):
+        """等待已追加的消息全部提交；都已提交或已关闭时直接返回"""
+        done = threading.Event()
+        with self.lock:
+            if self.closed or self.committed_id == self.next_id - 1:
+                return
+            self.queue.put(done)
+        done.wait()
+
+    def page(self, peer, before=None, limit=PAGE_SIZE):
+        """返回 id 小于 before 的最近 limit 条消息 [(id, 文字)]，按时间顺序"""
+        if self.closed:
+            return []
+        self.flush()
+        rows = self.reader.execute(
+            'SELECT id, text FROM messages WHERE peer = ? AND id < ? ORDER BY id DESC LIMIT ?',
+            (peer, before if before is not None else self.next_id, limit)).fetchall()
+        rows.reverse()
+        return rows
+
+    def page_after(self, peer, after, limit=PAGE_SIZE):
+        """返回 id 大于 after 的最早 limit 条消息 [(id, 文字)]"""
+        if self.closed:
+            return []
+        self.flush()
+        return self.reader.execute(
+            'SELECT id, text FROM messages WHERE peer = ? AND id > ? ORDER BY id LIMIT ?',
+            (peer, after, limit)).fetchall()
+
+    def close(self):
+        """提交尚未写入的消息并停止写入线程，可以重复调用"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(None)  # 在此之前排队的消息和 flush 都会先被处理
+        self.writer.join()
+        self.reader.close()
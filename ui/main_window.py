@@ -1,12 +1,15 @@
 from PySide6.QtWidgets import (QMainWindow, QWidget, QVBoxLayout, 
-                             QHBoxLayout, QTextEdit, QLineEdit, 
-                             QPushButton, QListWidget, QListWidgetItem,
+                             QHBoxLayout, QLineEdit, 
+                             QPushButton, QListWidget, QListWidgetItem, QAbstractItemView, QInputDialog,
                              QFileDialog, QMessageBox, QProgressBar, QLabel, QMenuBar, QMenu, QSystemTrayIcon)
 from PySide6.QtCore import Qt, Signal
 from PySide6.QtGui import QIcon, QPixmap
 import os
 from network.file_server import TransferStatus
 from .settings_dialog import SettingsDialog
+from .search_dialog import SearchDialog
+from .history import ChatHistory
+from .chat_view import ChatModel, ChatView
 import logging
 from datetime import datetime
 import json
@@ -16,6 +19,27 @@ class UserListItem(QListWidgetItem):
         super().__init__(username)
         self.ip = ip
 
+class GroupListItem(UserListItem):
+    """用户列表中的群组，聊天记录以 group:名称 为键"""
+
+    def __init__(self, name):
+        super().__init__(f"[群组] {name}", f"group:{name}")
+        self.name = name
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{int(size)} B"
+        size /= 1024
+
+def format_eta(seconds):
+    if seconds is None:
+        return "--:--"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    return f"{seconds // 60:02d}:{seconds % 60:02d}"
+
 class TransferWidget(QWidget):
     def __init__(self, filename, operation, parent=None):
         super().__init__(parent)
@@ -29,16 +53,23 @@ class TransferWidget(QWidget):
         self.progress.setMinimum(0)
         self.progress.setMaximum(100)
         
+        self.stats_label = QLabel()
         self.status_label = QLabel(TransferStatus.WAITING.value)
         self.cancel_button = QPushButton("取消")
         
         layout.addWidget(self.label)
         layout.addWidget(self.progress)
+        layout.addWidget(self.stats_label)
         layout.addWidget(self.status_label)
         layout.addWidget(self.cancel_button)
         
-    def update_progress(self, value):
-        self.progress.setValue(value)
+    def update_progress(self, stats):
+        self.progress.setValue(stats.percent)
+        self.stats_label.setText(
+            f"{format_size(stats.done)} / {format_size(stats.total)}  "
+            f"{format_size(stats.rate)}/s（平均 {format_size(stats.average)}/s）  "
+            f"剩余 {format_eta(stats.eta)}"
+        )
         
     def update_status(self, status: TransferStatus):
         self.status_label.setText(status.value)
@@ -46,6 +77,7 @@ class TransferWidget(QWidget):
             self.cancel_button.setEnabled(False)
 
 class MainWindow(QMainWindow):
+    send_group_signal = Signal(str, str, list)  # 消息, 群组名, 在线成员 IP
     send_message_signal = Signal(str, str)  # 消息, 目标IP
     send_file_signal = Signal(str, str)  # 文件路径, 目标IP
     cancel_transfer_signal = Signal(str)  # filename
@@ -71,6 +103,7 @@ class MainWindow(QMainWindow):
         users_layout = QVBoxLayout()
         self.user_list = QListWidget()
         self.user_list.setMaximumWidth(200)
+        self.user_list.setSelectionMode(QAbstractItemView.ExtendedSelection)  # 按住 Ctrl 选择多个用户群发
         self.user_list.itemClicked.connect(self.user_selected)
         users_layout.addWidget(self.user_list)
         
@@ -85,16 +118,37 @@ class MainWindow(QMainWindow):
         self.file_button.clicked.connect(self.send_file)
         users_layout.addWidget(self.file_button)
         
+        self.folder_button = QPushButton("发送文件夹")
+        self.folder_button.setEnabled(False)
+        self.folder_button.clicked.connect(self.send_folder)
+        users_layout.addWidget(self.folder_button)
+        
+        self.group_button = QPushButton("群发给选中用户")
+        self.group_button.clicked.connect(self.create_group)
+        users_layout.addWidget(self.group_button)
+        
         layout.addLayout(users_layout)
         
         # 右侧聊天区域
         chat_layout = QVBoxLayout()
         
-        # 聊天记录显示区域
-        self.chat_display = QTextEdit()
-        self.chat_display.setReadOnly(True)
+        # 聊天记录显示区域：按页从数据库读取，只绘制可见的行
+        # 聊天记录存储：后台线程批量写入 SQLite，首次启动时导入旧的 chat_history.json
+        self.history = ChatHistory()
+        self.chat_model = ChatModel(self.history, self)
+        self.chat_display = ChatView(self.chat_model)
         chat_layout.addWidget(self.chat_display)
         
+        # 最近一条消息的送达状态
+        self.delivery_label = QLabel()
+        chat_layout.addWidget(self.delivery_label)
+        self.delivery_states = {}  # {ip: 状态文字}
+        self.pending_messages = {}  # {消息 ID: 聊天记录中的文字}
+        self.last_sent = None
+        self.group_sends = {}  # {消息 ID: 群发的送达统计}
+        self.sending_group = None  # 正在发出的群发，同步报告的状态据此归入该群发
+        self.groups = {}  # {群组名: [成员 IP]}
+        
         # 添加文件传输进度区域
         self.transfer_layout = QVBoxLayout()
         self.transfers = {}  # {filename: TransferWidget}
@@ -126,14 +180,12 @@ class MainWindow(QMainWindow):
         
         # 加载保存的设置
         self.load_settings()
+        for name in self.groups:
+            self.user_list.addItem(GroupListItem(name))
         
         # 添加拖放支持
         self.setAcceptDrops(True)
         
-        # 添加聊天记录存储
-        self.chat_history = {}  # {ip: [messages]}
-        self.load_chat_history()
-        
         # 添加系统托盘图标
         self.tray_icon = QSystemTrayIcon(self)
         icon_pixmap = QPixmap(16, 16)
@@ -162,6 +214,9 @@ class MainWindow(QMainWindow):
         file_menu = menubar.addMenu("文件")
         settings_action = file_menu.addAction("设置")
         settings_action.triggered.connect(self.show_settings)
+        search_action = file_menu.addAction("搜索聊天记录")
+        search_action.setShortcut("Ctrl+F")
+        search_action.triggered.connect(self.show_search)
         file_menu.addSeparator()
         exit_action = file_menu.addAction("退出")
         exit_action.triggered.connect(self.close)
@@ -175,29 +230,71 @@ class MainWindow(QMainWindow):
         dialog.settings_changed.connect(self.handle_settings_changed)
         dialog.exec()
         
+    def show_search(self):
+        peers = []
+        for i in range(self.user_list.count()):
+            item = self.user_list.item(i)
+            peers.append((item.ip, item.text().split(' [')[0]))
+        dialog = SearchDialog(
+            self.history, peers,
+            current_peer=self.current_chat_user.ip if self.current_chat_user else None,
+            parent=self
+        )
+        dialog.open_message.connect(self.open_search_result)
+        dialog.exec()
+
+    def open_search_result(self, peer, message_id):
+        # 对方在列表中时切换到该对话，否则只显示记录（不能发送）
+        for i in range(self.user_list.count()):
+            item = self.user_list.item(i)
+            if item.ip == peer:
+                self.user_list.setCurrentItem(item)
+                self.user_selected(item)
+                break
+        else:
+            self.current_chat_user = None
+            self.send_button.setEnabled(False)
+            self.file_button.setEnabled(False)
+            self.folder_button.setEnabled(False)
+            self.delivery_label.setText("")
+        row = self.chat_model.load_around(peer, message_id)
+        self.chat_display.show_row(row)
+
     def load_settings(self):
         try:
             with open('settings.json', 'r', encoding='utf-8') as f:
                 settings = json.load(f)
                 username = settings.get('username', "未命名用户")
                 self.show_ip = settings.get('show_ip', True)
+                self.groups = settings.get('groups', {})
                 self.setWindowTitle(f"{username} - Python IPMSG")
         except:
             pass
             
     def save_settings(self):
         try:
+            # 保留其他模块写入的设置项（如传输限速）
+            try:
+                with open('settings.json', 'r', encoding='utf-8') as f:
+                    settings = json.load(f)
+            except:
+                settings = {}
+            settings.update({
+                'username': self.windowTitle().replace(" - Python IPMSG", ""),
+                'show_ip': self.show_ip,
+                'groups': self.groups
+            })
             with open('settings.json', 'w', encoding='utf-8') as f:
-                json.dump({
-                    'username': self.windowTitle().replace(" - Python IPMSG", ""),
-                    'show_ip': self.show_ip
-                }, f, ensure_ascii=False)
+                json.dump(settings, f, ensure_ascii=False)
         except:
             pass
             
     def refresh_users(self):
-        # 清空用户列表
-        self.user_list.clear()
+        # 列表保留，全部标记为未确认，收到回应的用户恢复正常显示
+        for i in range(self.user_list.count()):
+            item = self.user_list.item(i)
+            if not isinstance(item, GroupListItem):
+                self.set_user_stale(item, True)
         self.refresh_signal.emit()
         self.logger.info("User list refreshed")
         
@@ -212,6 +309,8 @@ class MainWindow(QMainWindow):
     def update_user_list(self):
         for i in range(self.user_list.count()):
             item = self.user_list.item(i)
+            if isinstance(item, GroupListItem):
+                continue
             if self.show_ip:
                 item.setText(f"{item.text().split(' [')[0]} [{item.ip}]")
             else:
@@ -219,34 +318,48 @@ class MainWindow(QMainWindow):
     
     def user_selected(self, item):
         self.current_chat_user = item
+        is_user = not isinstance(item, GroupListItem)
         self.send_button.setEnabled(True)
-        self.file_button.setEnabled(True)
+        self.file_button.setEnabled(is_user)
+        self.folder_button.setEnabled(is_user)
         
         # 切换聊天记录
-        self.chat_display.clear()
-        if item.ip in self.chat_history:
-            for msg in self.chat_history[item.ip]:
-                self.chat_display.append(msg)
+        self.delivery_label.setText(self.delivery_states.get(item.ip, ""))
+        self.chat_model.load_latest(item.ip)
                 
         # 清除粗体标记
         font = item.font()
         font.setBold(False)
         item.setFont(font)
         
-    def add_user(self, ip, username):
+    def add_user(self, ip, username, stale=False):
         # 修改现有方法
         for i in range(self.user_list.count()):
             item = self.user_list.item(i)
             if item.ip == ip:
                 display_name = f"{username} [{ip}]" if self.show_ip else username
                 item.setText(display_name)
+                self.set_user_stale(item, stale)
                 self.logger.info(f"User updated: {username} ({ip})")
                 return
         
         display_name = f"{username} [{ip}]" if self.show_ip else username
         item = UserListItem(display_name, ip)
+        self.set_user_stale(item, stale)
         self.user_list.addItem(item)
         self.logger.info(f"New user added: {username} ({ip})")
+    
+    def add_stale_user(self, ip, username):
+        # 上次保存的在线列表，收到对方回应之前灰色显示
+        self.add_user(ip, username, stale=True)
+    
+    def set_user_stale(self, item, stale):
+        if stale:
+            item.setForeground(Qt.gray)
+            item.setToolTip("尚未确认在线")
+        else:
+            item.setData(Qt.ForegroundRole, None)
+            item.setToolTip("")
         
     def remove_user(self, ip):
         # 修改现有方法
@@ -258,6 +371,7 @@ class MainWindow(QMainWindow):
                     self.current_chat_user = None
                     self.send_button.setEnabled(False)
                     self.file_button.setEnabled(False)
+                    self.folder_button.setEnabled(False)
                 self.logger.info(f"User removed: {item.text()} ({ip})")
                 break
                 
@@ -266,13 +380,112 @@ class MainWindow(QMainWindow):
             return
             
         message = self.message_input.text()
-        if message:
+        if message and isinstance(self.current_chat_user, GroupListItem):
+            self.send_group_message(self.current_chat_user, message)
+        elif message:
             msg_text = f"我: {message}"
-            self.chat_display.append(msg_text)
             self.add_chat_message(self.current_chat_user.ip, msg_text)
+            self.last_sent = msg_text  # 发送时同步报告的第一个状态据此对应到这条消息
             self.send_message_signal.emit(message, self.current_chat_user.ip)
             self.message_input.clear()
             
+    def create_group(self):
+        members = [item for item in self.user_list.selectedItems() if not isinstance(item, GroupListItem)]
+        if len(members) < 2:
+            QMessageBox.information(self, "群发", "请按住 Ctrl 在用户列表中选择至少两个用户")
+            return
+        name, ok = QInputDialog.getText(self, "群发", "群组名称:")
+        name = name.strip()
+        if not ok or not name:
+            return
+        self.groups[name] = [item.ip for item in members]
+        self.save_settings()
+        for i in range(self.user_list.count()):
+            item = self.user_list.item(i)
+            if isinstance(item, GroupListItem) and item.name == name:
+                break
+        else:
+            item = GroupListItem(name)
+            self.user_list.insertItem(0, item)
+        self.user_list.setCurrentItem(item)
+        self.user_selected(item)
+        self.logger.info(f"Group {name} created with {len(members)} members")
+        # 输入框中已有内容时直接发出
+        if self.message_input.text():
+            self.send_message()
+    
+    def send_group_message(self, group_item, message):
+        online = {self.user_list.item(i).ip for i in range(self.user_list.count())}
+        members = [ip for ip in self.groups.get(group_item.name, []) if ip in online]
+        if not members:
+            self.delivery_label.setText("群组成员都不在线")
+            return
+        msg_text = f"我: {message}"
+        self.add_chat_message(group_item.ip, msg_text)  # 群发只记一条记录
+        self.sending_group = {'key': group_item.ip, 'text': msg_text, 'total': len(members),
+                              'delivered': 0, 'sent': 0, 'failed': []}
+        try:
+            self.send_group_signal.emit(message, group_item.name, members)
+        finally:
+            self.sending_group = None
+        self.message_input.clear()
+    
+    def update_group_status(self, stats, ip, state):
+        if state == 'delivered':
+            stats['delivered'] += 1
+        elif state == 'sent':
+            stats['sent'] += 1
+        elif state == 'failed':
+            stats['failed'].append(ip)
+            notice = f"（{ip} 未收到：{stats['text'][:40]}）"
+            self.add_chat_message(stats['key'], notice)
+        text = f"已送达 {stats['delivered']}/{stats['total']}"
+        if stats['sent']:
+            text += f"，{stats['sent']} 人无送达确认"
+        if stats['failed']:
+            text += f"，{len(stats['failed'])} 人发送失败"
+        self.delivery_states[stats['key']] = text
+        if self.current_chat_user and self.current_chat_user.ip == stats['key']:
+            self.delivery_label.setText(text)
+    
+    def update_delivery_status(self, ip, message_id, state, done, total):
+        if self.sending_group is not None:
+            if message_id:
+                self.group_sends[message_id] = self.sending_group
+            else:
+                self.update_group_status(self.sending_group, ip, state)  # 旧版成员单包发送
+                return
+        stats = self.group_sends.get(message_id)
+        if stats is not None:
+            if state != 'sending':
+                self.update_group_status(stats, ip, state)
+                if stats['delivered'] + stats['sent'] + len(stats['failed']) >= stats['total']:
+                    del self.group_sends[message_id]
+            return
+        if message_id and message_id not in self.pending_messages:
+            self.pending_messages[message_id] = self.last_sent
+        if state == 'sending':
+            text = f"发送中 {done}/{total}" if total > 1 else "发送中"
+        elif state == 'delivered':
+            text = "已送达"
+        elif state == 'sent':
+            text = "已发送（对方版本不支持送达确认）"
+        else:
+            text = "发送失败"
+            msg_text = self.pending_messages.get(message_id) or self.last_sent or ""
+            notice = f"（未送达：{msg_text[:40]}）"
+            self.add_chat_message(ip, notice)
+            self.logger.warning(f"Message to {ip} not delivered")
+        if state != 'sending':
+            self.pending_messages.pop(message_id, None)
+        self.delivery_states[ip] = text
+        if self.current_chat_user and self.current_chat_user.ip == ip:
+            self.delivery_label.setText(text)
+    
+    def receive_group_message(self, sender_ip, group, message):
+        # 群发的消息显示在发送者的对话中
+        self.receive_message(sender_ip, f"[{group}] {message}")
+    
     def receive_message(self, sender_ip, message):
         username = "未知用户"
         for i in range(self.user_list.count()):
@@ -301,7 +514,6 @@ class MainWindow(QMainWindow):
                     break
         
         # 添加消息到聊天记录
-        self.chat_display.append(msg_text)
         self.add_chat_message(sender_ip, msg_text)
         
     def send_file(self):
@@ -310,14 +522,25 @@ class MainWindow(QMainWindow):
             
         file_path, _ = QFileDialog.getOpenFileName(self, "选择文件")
         if file_path:
-            # 添加传输进度显示
-            filename = os.path.basename(file_path)
-            self.add_transfer_progress(filename, 'send')
-            # 保存文件路径以供后续使用
-            self.pending_files = getattr(self, 'pending_files', {})
-            self.pending_files[filename] = file_path
-            # 发送文件请求
-            self.send_file_signal.emit(file_path, self.current_chat_user.ip)
+            self.request_send(file_path)
+            
+    def send_folder(self):
+        if not self.current_chat_user:
+            return
+            
+        folder_path = QFileDialog.getExistingDirectory(self, "选择文件夹")
+        if folder_path:
+            self.request_send(folder_path)
+            
+    def request_send(self, file_path):
+        # 添加传输进度显示，文件夹以目录名作为一个传输
+        filename = os.path.basename(os.path.normpath(file_path))
+        self.add_transfer_progress(filename, 'send')
+        # 保存文件路径以供后续使用
+        self.pending_files = getattr(self, 'pending_files', {})
+        self.pending_files[filename] = file_path
+        # 发送文件请求
+        self.send_file_signal.emit(file_path, self.current_chat_user.ip)
             
     def handle_file_request(self, sender_ip, filename, size, sender_name):
         size_mb = size / (1024 * 1024)  # size 已经是整数了
@@ -346,6 +569,24 @@ class MainWindow(QMainWindow):
         else:
             # 用户点击了拒绝按钮，发送拒绝信号
             self.file_response_signal.emit(filename, sender_ip, False)
+            
+    def handle_batch_request(self, sender_ip, folder_name, size, count, sender_name):
+        size_mb = size / (1024 * 1024)
+        msg = QMessageBox()
+        msg.setIcon(QMessageBox.Question)
+        msg.setText(f"{sender_name} 想要发送文件夹给你")
+        msg.setInformativeText(f"文件夹: {folder_name}\n文件数: {count}\n大小: {size_mb:.2f} MB")
+        msg.setStandardButtons(QMessageBox.Ok | QMessageBox.Cancel)
+        
+        if msg.exec() == QMessageBox.Ok:
+            save_dir = QFileDialog.getExistingDirectory(self, "选择保存位置")
+            if save_dir:
+                self.add_transfer_progress(folder_name, 'receive')
+                # 文件夹会在所选目录下以原名重建
+                self.set_save_path_signal.emit(folder_name, save_dir)
+                self.file_response_signal.emit(folder_name, sender_ip, True)
+                return
+        self.file_response_signal.emit(folder_name, sender_ip, False)
         
     def add_transfer_progress(self, filename, operation):
         if filename not in self.transfers:
@@ -356,9 +597,9 @@ class MainWindow(QMainWindow):
             self.transfers[filename] = widget
             self.transfer_layout.addWidget(widget)
             
-    def update_transfer_progress(self, filename, operation, value):
+    def update_transfer_progress(self, filename, operation, stats):
         if filename in self.transfers:
-            self.transfers[filename].update_progress(value)
+            self.transfers[filename].update_progress(stats)
             
     def update_transfer_status(self, filename, status):
         if filename in self.transfers:
@@ -387,6 +628,7 @@ class MainWindow(QMainWindow):
         
         if reply == QMessageBox.Yes:
             self.save_settings()  # 保存设置
+            self.history.close()  # 提交尚未写入的聊天记录
             self.logger.info("Application closing")
             event.accept()
         else:
@@ -400,9 +642,8 @@ class MainWindow(QMainWindow):
         if self.current_chat_user:
             for url in event.mimeData().urls():
                 file_path = url.toLocalFile()
-                if os.path.isfile(file_path):
-                    self.add_transfer_progress(os.path.basename(file_path), 'send')
-                    self.send_file_signal.emit(file_path, self.current_chat_user.ip)
+                if os.path.isfile(file_path) or os.path.isdir(file_path):
+                    self.request_send(file_path)
                     
     def handle_file_transfer_complete(self, filename, operation, target_ip):
         widget = self.transfers.get(filename)
@@ -415,25 +656,12 @@ class MainWindow(QMainWindow):
             QMessageBox.information(self, "传输完成", f"文件 {filename} 已成功接收")
         self.logger.info(f"File transfer complete: {filename} ({operation})")
         
-    def save_chat_history(self):
-        try:
-            with open('chat_history.json', 'w', encoding='utf-8') as f:
-                json.dump(self.chat_history, f, ensure_ascii=False)
-        except Exception as e:
-            self.logger.error(f"Error saving chat history: {e}")
-            
-    def load_chat_history(self):
-        try:
-            with open('chat_history.json', 'r', encoding='utf-8') as f:
-                self.chat_history = json.load(f)
-        except:
-            self.chat_history = {}
-            
     def add_chat_message(self, ip, message):
-        if ip not in self.chat_history:
-            self.chat_history[ip] = []
-        self.chat_history[ip].append(message)
-        self.save_chat_history() 
+        # 只放入写入队列，不在界面线程写磁盘；当前对话同时加入视图
+        message_id = self.history.append(ip, message)
+        if self.chat_model.peer == ip:
+            self.chat_model.append(message_id, message)
+
 
     def handle_file_transfer_accepted(self, filename, target_ip):
         # 当接收方接受文件时，开始实际的文件传输
@@ -0,0 +1,83 @@
+from PySide6.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit,
+                             QComboBox, QPushButton, QListWidget, QListWidgetItem)
+from PySide6.QtCore import Qt, Signal
+from datetime import datetime
+import time
+
+# 时间范围选项：(显示文字, 往前的秒数)；"今天" 从本地时间零点开始
+TODAY = 'today'
+TIME_RANGES = [("全部时间", None), ("今天", TODAY), ("最近 7 天", 7 * 86400), ("最近 30 天", 30 * 86400)]
+
+class SearchDialog(QDialog):
+    open_message = Signal(str, int)  # peer, 消息 id
+
+    def __init__(self, history, peers, current_peer=None, parent=None):
+        """peers 为 [(peer, 显示名称)]，用于范围选择和结果显示"""
+        super().__init__(parent)
+        self.setWindowTitle("搜索聊天记录")
+        self.setMinimumSize(600, 400)
+        self.history = history
+        self.names = dict(peers)
+
+        layout = QVBoxLayout(self)
+
+        # 搜索条件
+        query_layout = QHBoxLayout()
+        self.query_input = QLineEdit()
+        self.query_input.setPlaceholderText("输入关键词，多个词用空格分隔")
+        self.peer_combo = QComboBox()
+        self.peer_combo.addItem("所有对话", None)
+        for peer, name in peers:
+            self.peer_combo.addItem(name, peer)
+        if current_peer is not None:
+            index = self.peer_combo.findData(current_peer)
+            if index >= 0:
+                self.peer_combo.setCurrentIndex(index)
+        self.range_combo = QComboBox()
+        for label, seconds in TIME_RANGES:
+            self.range_combo.addItem(label, seconds)
+        search_button = QPushButton("搜索")
+        query_layout.addWidget(self.query_input)
+        query_layout.addWidget(self.peer_combo)
+        query_layout.addWidget(self.range_combo)
+        query_layout.addWidget(search_button)
+        layout.addLayout(query_layout)
+
+        # 搜索结果，双击打开对应的对话
+        self.results = QListWidget()
+        self.results.setWordWrap(True)
+        layout.addWidget(self.results)
+        self.status_label = QLabel()
+        layout.addWidget(self.status_label)
+
+        # 连接信号
+        search_button.clicked.connect(self.search)
+        self.query_input.returnPressed.connect(self.search)
+        self.results.itemDoubleClicked.connect(self.result_selected)
+
+    def search(self):
+        seconds = self.range_combo.currentData()
+        if seconds == TODAY:
+            since = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+        else:
+            since = time.time() - seconds if seconds else None
+        start = time.perf_counter()
+        rows = self.history.search(self.query_input.text(), peer=self.peer_combo.currentData(), since=since)
+        elapsed = time.perf_counter() - start
+
+        self.results.clear()
+        for message_id, peer, ts, text in rows:
+            when = datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M') if ts else "导入的记录"
+            item = QListWidgetItem(f"[{self.names.get(peer, peer)}  {when}]  {text}")
+            item.setData(Qt.UserRole, (peer, message_id))
+            self.results.addItem(item)
+
+        status = f"找到 {len(rows)} 条，用时 {elapsed * 1000:.0f} 毫秒"
+        progress = self.history.index_progress()
+        if progress < 1:
+            status += f"（索引建立中 {progress:.0%}，较早的记录可能搜不到）"
+        self.status_label.setText(status)
+
+    def result_selected(self, item):
+        peer, message_id = item.data(Qt.UserRole)
+        self.open_message.emit(peer, message_id)